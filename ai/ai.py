@@ -4,27 +4,66 @@ import json
 import random
 from log import log as log
 from raycaster_fast import Raycaster
+from geometry import get_geometry
+from sensor_frame import SensorFrame
 import math
 import time
-from player import Player
+from enemy_tracker import EnemyTracker
+from gamestate import Decoder, PlayerState
+from mailbox import Mailbox
+from metrics import TickMetrics
+from recorder import Recorder
+from command_writer import CommandWriter
+from render_snapshot import game_snapshot, lobby_snapshot
+import os
+
+# Stages of the decision pipeline, "wait" is the time a line sat in the mailbox, "queued" the time
+# from handing a command to the writer until the kernel took all of it and "total" the time from
+# the arrival of a line to its command being handed to the writer.
+STAGES = ("wait", "decode", "update", "sense", "track_enemies", "obstacle_avoidance", "find_target",
+          "short_distance_safety", "target_verification", "render", "send", "queued", "total")
 
 
 class AI(object):
-    def __init__(self, name, id, renderer, host="localhost", port=2016):
+    def __init__(self, name, id, renderer, host="localhost", port=2016, threaded=True, record_dir=None, sock=None):
         # Attributes
         self.active = True
-        self.enemies = {}
+        self.enemies = EnemyTracker()
+        self.decoder = Decoder()
         self.id = id
         self.renderer = renderer
         self.raycaster = None
+        self.walls = None
+        self.frame = None
+        self.snapshot = None
         self.last_time = time.time()
-        self.lines = []
+        self.mailbox = Mailbox()
+        self.metrics = TickMetrics(STAGES)
+        self.recorder = None
 
         # Connect to server and send handshake with name
-        self.socket = socket.socket()
-        self.socket.connect((host, port))
+        if sock is None:
+            sock = socket.socket()
+            # Small writes 30 times a second, waiting to fill a segment only adds latency.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                sock.connect((host, port))
+            except socket.error:
+                sock.close()
+                raise
+        self.socket = sock
+        self.socket.sendall(json.dumps({"name": name + "_" + str(id)}) + "\n")
+        self.writer = CommandWriter(self.socket, self.metrics)
+
+        # Only connected AIs record, a failed attempt leaves no empty recording behind.
+        if record_dir is not None:
+            self.recorder = Recorder(os.path.join(record_dir, "ai_" + str(id) + "_" + str(int(time.time())) + ".jsonl"))
+
+        # Without threads an EventLoop feeds the lines.
+        self.thread = None
+        if not threaded:
+            return
         self.socket_file = self.socket.makefile()
-        self.socket.send(json.dumps({"name": name + "_" + str(id)}) + "\n")
 
         # Run thread for network retrieving
         self.thread = Thread(target=self.run)
@@ -36,59 +75,80 @@ class AI(object):
         self.thread.setDaemon(True)
         self.thread.start()
 
+    def is_rendering(self):
+        return self.renderer.get_selected_player() == self.id or (self.renderer.get_selected_player() == 0 and self.id == 1)
+
     def run(self):
         while self.active:
-            # Read line by line and append it to buffer.
+            # Read line by line, only the newest one is kept.
             line = self.socket_file.readline().rstrip('\n')
-            self.lines.append(line)
-
-            # Track performance
-            tps = int(10.0/(time.time() - self.last_time))/10.0
-            if (self.renderer.get_selected_player() == self.id or (self.renderer.get_selected_player() == 0 and self.id == 1)) and (tps < 10 or tps > 20):
-                log("Unstable TPS: " + str(tps))
-            self.last_time = time.time()
+            self.track_tps()
+            if self.recorder is not None and line:
+                self.recorder.record(line)
 
             # Server is shutting down
             if not line or line == "":
                 self.active = False
+                self.mailbox.close()
+            else:
+                self.mailbox.put(line)
+
+    def track_tps(self):
+        # Track performance
+        tps = int(10.0/(time.time() - self.last_time))/10.0
+        if self.is_rendering() and (tps < 10 or tps > 20):
+            log("Unstable TPS: " + str(tps))
+        self.last_time = time.time()
 
     def run_ai(self):
         while self.active:
-            # Wait for new stuff.
-            if len(self.lines) < 1:
-                time.sleep(0.01)
-                continue
-            # read most recent line from network
-            line = self.lines[-1]
-            self.lines = []
-            packet = json.loads(line)
-
-            if "gamestate" in packet:
-                # extract info from packet
-                player = packet["gamestate"]["player"]
-                enemies = packet["gamestate"]["players"]
-                projectiles = packet["gamestate"]["projectiles"]
-                walls = packet["gamestate"]["walls"]
-                ranking = packet["gamestate"]["ranking"]
-                remaining_ticks = packet["gamestate"]["remaining_ticks"]
-
-                # handle the packet
-                self.handle(player, enemies, projectiles, walls, ranking, remaining_ticks)
-            else:
-                # If in charge with rendering, update renderer
-                if self.renderer.get_selected_player() == self.id or (self.renderer.get_selected_player() == 0 and self.id == 1):
-                    if "lobby" in packet:
-                        self.renderer.set_lobby(packet["lobby"]["timeout"])
+            # Wait for the most recent line from network
+            line = self.mailbox.take()
+            if line is None:
+                break
+            self.process(line, self.mailbox.taken_arrival)
+        self.stop()
+        self.disconnected()
 
+    def process(self, line, arrival=None):
+        if not line:
+            return
+        self.metrics.start(arrival)
+        self.metrics.record("wait", self.metrics.last - self.metrics.arrival)
+        packet, state = self.decoder.decode(line)
+
+        if state is not None:
+            self.metrics.lap("decode")
+
+            # handle the packet
+            self.handle(state.player, state.players, state.projectiles, state.walls, state.ranking, state.remaining_ticks)
+        else:
+            self.metrics.lap("decode")
+            # If in charge with rendering, update renderer
+            if self.is_rendering():
+                if "lobby" in packet:
+                    self.publish(lobby_snapshot(self.snapshot, packet["lobby"]["timeout"]))
+
+    def disconnected(self):
         # If in charge with rendering, update renderer
-        if self.renderer.get_selected_player() == self.id or (self.renderer.get_selected_player() == 0 and self.id == 1):
-            self.renderer.set_lobby(0)
+        if self.is_rendering():
+            self.publish(lobby_snapshot(self.snapshot, 0))
+
+    def publish(self, snapshot):
+        # The snapshot is never changed after this, the renderer just swaps its reference.
+        self.snapshot = snapshot
+        self.renderer.publish(snapshot)
 
     def handle(self, player, enemies, projectiles, walls, ranking, remaining_ticks):
-        # Create raycaster if not exists.
-        if self.raycaster is None:
-            self.raycaster = Raycaster(walls)
+        # Create raycaster if not exists or the map changed. The decoder hands out the same walls
+        # array as long as the walls stay the same.
+        if self.raycaster is None or walls is not self.walls:
+            self.walls = walls
+            self.raycaster = Raycaster(get_geometry(walls))
         self.raycaster.update(enemies)
+        self.metrics.lap("update")
+        self.frame = SensorFrame(self.raycaster, player)
+        self.metrics.lap("sense")
 
         # Defaults
         speed = 1
@@ -98,58 +158,47 @@ class AI(object):
         enemy = None
 
         # Processing pipeline.   
-        self.track_enemies(enemies)
+        remembered = self.track_enemies(enemies)
+        self.metrics.lap("track_enemies")
         speed, turn, aim, shot, enemy = self.obstacle_avoidance(player, enemies, projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy)
-        speed, turn, aim, shot, enemy = self.find_target(player, self.enemies.values(), projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy)
+        self.metrics.lap("obstacle_avoidance")
+        speed, turn, aim, shot, enemy = self.find_target(player, remembered, projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy)
+        self.metrics.lap("find_target")
         speed, turn, aim, shot, enemy = self.short_distance_safety(player, enemies, projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy)
+        self.metrics.lap("short_distance_safety")
         speed, turn, aim, shot, enemy = self.target_verification(player, enemies, projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy)
+        self.metrics.lap("target_verification")
 
 
         # If in charge with rendering, update renderer
-        if self.renderer.get_selected_player() == self.id or (self.renderer.get_selected_player() == 0 and self.id == 1):
-            players = list(self.enemies.values())
+        if self.is_rendering():
+            players = list(remembered)
             players.append(player)
-            self.renderer.set_game(player, players, projectiles, walls, ranking, remaining_ticks)
+            self.publish(game_snapshot(player, players, projectiles, self.raycaster.geometry.key,
+                                       self.raycaster.get_map(), ranking, remaining_ticks))
+        self.metrics.lap("render")
 
         # Send over network
-        self.socket.send(json.dumps({"speed": speed, "turn": turn, "shoot": shot, "aim": aim}) + "\n")
+        self.writer.write(speed, turn, shot, aim)
+        self.metrics.lap("send")
+        self.metrics.since_arrival("total")
 
     def track_enemies(self, enemies):
-        toremove = []
-        for enemy in self.enemies:
-            e = self.enemies[enemy]
-            e["forget_me"] = e["forget_me"] - 1
-            if e["forget_me"] <= 0:
-                toremove.append(enemy)
-            if e["respawn"] == 0:
-                Player.move(self.raycaster, e)
-            else:
-                e["respawn"] = e["respawn"] - 1
-                if e["respawn"] == 0:
-                    toremove.append(enemy)
-            e["aimspeed"] = e["aimspeed"] * 0.8
-            e["turnspeed"] = e["turnspeed"] * 0.8
-            e["movespeed"] = e["movespeed"] * 0.99
-        for x in toremove:
-            del self.enemies[x]
-
-        for enemy in enemies:
-            self.enemies[enemy["name"]] = enemy
-            enemy["forget_me"] = 30 * 5
-                
+        # Dead reckon the enemies out of sight and remember the visible ones.
+        self.enemies.update(self.raycaster, enemies)
+        return self.enemies.values()
+
     def obstacle_avoidance(self, player, enemies, projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy):
         # Check whats left
-        ray = {"x": player["x"], "y": player["y"], "theta": player["theta"] + math.radians(20)}
-        tx, ty, obj = self.raycaster.cast(ray, collision_mode=True)
-        dx = tx - player["x"]
-        dy = ty - player["y"]
+        tx, ty, obj = self.frame.cast(player.theta + math.radians(20), collision_mode=True)
+        dx = tx - player.x
+        dy = ty - player.y
         dleft = dx * dx + dy * dy
         
         # Check whats right 
-        ray = {"x": player["x"], "y": player["y"], "theta": player["theta"] - math.radians(20)}
-        tx, ty, obj = self.raycaster.cast(ray, collision_mode=True)
-        dx = tx - player["x"]
-        dy = ty - player["y"]
+        tx, ty, obj = self.frame.cast(player.theta - math.radians(20), collision_mode=True)
+        dx = tx - player.x
+        dy = ty - player.y
         dright = dx * dx + dy * dy
         
         # Calculate how to evade if nescessary.
@@ -161,10 +210,9 @@ class AI(object):
         
     def short_distance_safety(self, player, enemies, projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy):
         # Calculate how far it can drive straight
-        ray = {"x": player["x"], "y": player["y"], "theta": player["theta"]}
-        tx, ty, obj = self.raycaster.cast(ray, collision_mode=True)
-        dx = tx - player["x"]
-        dy = ty - player["y"]
+        tx, ty, obj = self.frame.cast(player.theta, collision_mode=True)
+        dx = tx - player.x
+        dy = ty - player.y
         
         # If to short turn
         if dx * dx + dy * dy < 10:
@@ -185,10 +233,10 @@ class AI(object):
         enemy = None
         edist2 = 0
         for e in enemies:
-            if e["respawn"] > 0:
+            if e.respawn > 0:
                 continue
-            dx = e["x"] - player["x"]
-            dy = e["x"] - player["x"]
+            dx = e.x - player.x
+            dy = e.x - player.x
             d = dx * dx + dy * dy
             if enemy is None or edist2 > d:
                 enemy = e
@@ -196,11 +244,11 @@ class AI(object):
                 
         # Calculate turn and aim towards target
         if enemy is not None:
-            dx = enemy["x"] - player["x"]
-            dy = enemy["y"] - player["y"]
+            dx = enemy.x - player.x
+            dy = enemy.y - player.y
             
             # Calculate and normalize theta angle
-            dtheta = math.atan2(dy, dx) - player["theta"]
+            dtheta = math.atan2(dy, dx) - player.theta
             while dtheta <= -math.pi:
                 dtheta += math.pi * 2
             while dtheta > math.pi:
@@ -213,7 +261,7 @@ class AI(object):
             turn = max(-0.75, min(0.75, turn))
             
             # Calculate and normalize aim angle
-            dtheta = math.atan2(dy, dx) - player["aim"]
+            dtheta = math.atan2(dy, dx) - player.aim
             while dtheta <= -math.pi:
                 dtheta += math.pi * 2
             while dtheta > math.pi:
@@ -231,15 +279,14 @@ class AI(object):
         
     def target_verification(self, player, enemies, projectiles, walls, ranking, remaining_ticks, speed, turn, aim, shot, enemy):
         # Calculate the shooting direction
-        ray = {"x": player["x"], "y": player["y"], "theta": player["aim"]}
-        tx, ty, obj = self.raycaster.cast(ray)
-        dx = tx - player["x"]
-        dy = ty - player["y"]
+        tx, ty, obj = self.frame.cast(player.aim)
+        dx = tx - player.x
+        dy = ty - player.y
 
         l = max(5.0, math.sqrt(dx * dx + dy * dy))
 
         # Check if we hit and have an enemy
-        if enemy is None or len(obj) < 3 or l > 40:
+        if enemy is None or not isinstance(obj, PlayerState) or l > 40:
             shot = 0
         else:
             speed = 0
@@ -248,7 +295,7 @@ class AI(object):
 
         # Calculate if bloom is too bad
         l = max(5.0, math.sqrt(dx * dx + dy * dy))
-        if player["bloom"] > math.asin(0.5/l):
+        if player.bloom > math.asin(0.5/l):
             if enemy is None:
                 speed = 0
             else:
@@ -257,8 +304,19 @@ class AI(object):
             
         return speed, turn, aim, shot, enemy
 
+    def get_metrics(self):
+        return self.metrics.get()
+
+    def report_metrics(self):
+        return ("AI " + str(self.id) + " tick timings, " + str(self.mailbox.stats()) + ", " + str(self.writer.stats()) +
+                "\n" + self.metrics.report())
+
     def stop(self):
         self.active = False
+        self.mailbox.close()
+        if self.recorder is not None:
+            self.recorder.close()
 
     def join(self):
-        self.thread.join()
\ No newline at end of file
+        if self.thread is not None:
+            self.thread.join()
\ No newline at end of file
@@ -0,0 +1,158 @@
+from __future__ import division
+import math
+import numpy as np
+
+CELL_SIZE = 0.5
+MAX_CELLS_PER_AXIS = 256
+MAX_CLEARANCE = 8.0
+TILE = 16
+NO_HIT = (float("inf"), 0.0, 0.0, -1)
+MAX_STEPS = 64
+
+# Marching stops this many cells away from a wall, the exact test then looks REACH cells around the stop.
+STOP_CELLS = 1.0
+REACH_CELLS = 3.0
+
+
+class ClearanceField(object):
+    # Distance from every cell center to the nearest segment, capped at MAX_CLEARANCE, plus the
+    # segments close to every cell. Distances are 1-Lipschitz, so the value at a cell center minus
+    # the distance to it is a safe radius around any point.
+    def __init__(self, segments, cell=CELL_SIZE, max_clearance=MAX_CLEARANCE, index=None):
+        self.segments = segments
+        if len(segments) > 0:
+            self.min_x = min(segments[:, 0].min(), segments[:, 2].min())
+            self.min_y = min(segments[:, 1].min(), segments[:, 3].min())
+            width = max(segments[:, 0].max(), segments[:, 2].max()) - self.min_x
+            height = max(segments[:, 1].max(), segments[:, 3].max()) - self.min_y
+        else:
+            self.min_x = self.min_y = width = height = 0.0
+        self.cell = max(cell, max(width, height) / MAX_CELLS_PER_AXIS)
+        self.nx = max(1, int(math.ceil(width / self.cell)))
+        self.ny = max(1, int(math.ceil(height / self.cell)))
+        self.max_clearance = max_clearance
+        self.stop = STOP_CELLS * self.cell
+        self.reach = (math.sqrt(0.5) + REACH_CELLS) * self.cell
+
+        if index is not None:
+            # Built before, e.g. by another process (see get_arrays).
+            self.field, self.cell_items, self.cell_start = index
+        else:
+            self.build()
+        for array in (self.field, self.cell_items, self.cell_start):
+            array.flags.writeable = False
+
+    def build(self):
+        self.field = np.full(self.nx * self.ny, self.max_clearance)
+        cells = []
+        items = []
+        for ty in range(0, self.ny, TILE):
+            for tx in range(0, self.nx, TILE):
+                self.build_tile(tx, ty, cells, items)
+        cells = np.concatenate(cells) if cells else np.empty(0, dtype=int)
+        items = np.concatenate(items) if items else np.empty(0, dtype=int)
+        order = np.argsort(cells, kind="mergesort")
+        self.cell_items = items[order]
+        self.cell_start = np.zeros(self.nx * self.ny + 1, dtype=int)
+        self.cell_start[1:] = np.cumsum(np.bincount(cells, minlength=self.nx * self.ny))
+
+    def get_arrays(self):
+        # The built index, passing it back as index skips the build.
+        return self.field, self.cell_items, self.cell_start
+
+    def build_tile(self, tx, ty, cells, items):
+        # Exact distances for one tile of cells, only segments within reach of the tile take part.
+        ix = np.arange(tx, min(tx + TILE, self.nx))
+        iy = np.arange(ty, min(ty + TILE, self.ny))
+        gx, gy = np.meshgrid(ix, iy)
+        gx = gx.ravel()
+        gy = gy.ravel()
+        px = (self.min_x + (gx + 0.5) * self.cell)[:, None]
+        py = (self.min_y + (gy + 0.5) * self.cell)[:, None]
+
+        s = self.segments
+        margin = max(self.max_clearance, self.reach)
+        close = ((np.minimum(s[:, 0], s[:, 2]) <= px.max() + margin) & (np.maximum(s[:, 0], s[:, 2]) >= px.min() - margin) &
+                 (np.minimum(s[:, 1], s[:, 3]) <= py.max() + margin) & (np.maximum(s[:, 1], s[:, 3]) >= py.min() - margin))
+        candidates = np.nonzero(close)[0]
+        if len(candidates) == 0:
+            return
+        x0 = s[candidates, 0]
+        y0 = s[candidates, 1]
+        ex = s[candidates, 2] - x0
+        ey = s[candidates, 3] - y0
+        length2 = ex * ex + ey * ey
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u = np.where(length2 > 0, ((px - x0) * ex + (py - y0) * ey) / length2, 0.0)
+        u = np.clip(u, 0.0, 1.0)
+        dx = px - (x0 + u * ex)
+        dy = py - (y0 + u * ey)
+        dist = np.sqrt(dx * dx + dy * dy)
+
+        flat = gy * self.nx + gx
+        self.field[flat] = np.minimum(dist.min(axis=1), self.max_clearance)
+        rows, columns = np.nonzero(dist <= self.reach)
+        cells.append(flat[rows])
+        items.append(candidates[columns])
+
+    def trace(self, x, y, dax, day, length):
+        # Nearest segment hit by the ray from (x, y) along (dax, day), as (d2, hx, hy, index) with index -1
+        # on a miss. Sphere tracing on plain floats, near a segment the close ones are tested exactly.
+        # None if the ray runs out of steps. Reads the arrays in place through item(), they may be mapped
+        # from a file shared with other processes.
+        value = self.field.item
+        start = self.cell_start.item
+        c = dax / length
+        s = day / length
+        t = 0.0
+        for _ in range(MAX_STEPS):
+            px = x + c * t
+            py = y + s * t
+            i = min(self.nx - 1, max(0, int(math.floor((px - self.min_x) / self.cell))))
+            j = min(self.ny - 1, max(0, int(math.floor((py - self.min_y) / self.cell))))
+            offset = math.hypot(px - (self.min_x + (i + 0.5) * self.cell), py - (self.min_y + (j + 0.5) * self.cell))
+            cell = j * self.nx + i
+            safe = value(cell) - offset
+            if safe < self.stop:
+                # The near list is complete within radius, a hit inside it is the nearest one.
+                radius = self.reach - offset
+                if radius <= 0:
+                    return None
+                ids = self.cell_items[start(cell):start(cell + 1)]
+                best = nearest_hit(x, y, dax, day, ids.tolist(), self.segments[ids].tolist(), NO_HIT)
+                limit = t + radius
+                if best[3] >= 0 and best[0] <= limit * limit:
+                    return best
+                # Passing by, the ray is free up to the end of the radius.
+                safe = radius
+            t += safe
+            if t > length:
+                return NO_HIT
+        return None
+
+
+def nearest_hit(x1, y1, dax, day, ids, rows, best):
+    # Closest hit of the ray with the segments rows, numbered ids, if closer than best. Same arithmetic
+    # as Raycaster.closest_hits.
+    for i, (x3, y3, x4, y4) in zip(ids, rows):
+        dbx = x4 - x3
+        dby = y4 - y3
+        denom = -day * dbx + dax * dby
+        if denom == 0:
+            continue
+        dpx = x1 - x3
+        dpy = y1 - y3
+        s = (-day * dpx + dax * dpy) / denom
+        if s < 0 or s > 1:
+            continue
+        s2 = (dby * dpx - dbx * dpy) / -denom
+        if s2 < 0 or s2 > 1:
+            continue
+        hx = x3 + s * dbx
+        hy = y3 + s * dby
+        dx = x1 - hx
+        dy = y1 - hy
+        d2 = dx * dx + dy * dy
+        if d2 < best[0]:
+            best = (d2, hx, hy, i)
+    return best
@@ -0,0 +1,85 @@
+import errno
+import json
+import math
+import socket
+import time
+
+# Lets a send return instead of blocking while the kernel buffer is full, blocking sends where it is missing.
+DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+def format_number(value):
+    value = float(value)
+    if math.isinf(value) or math.isnan(value):
+        return json.dumps(value)
+    return repr(value)
+
+
+def format_command(speed, turn, shoot, aim):
+    # Same fields as json.dumps of the command dict, without building the dict.
+    return ('{"speed": ' + format_number(speed) + ', "turn": ' + format_number(turn) +
+            ', "shoot": ' + str(int(shoot)) + ', "aim": ' + format_number(aim) + '}\n')
+
+
+class CommandWriter(object):
+    # Writes the commands of one AI without ever blocking on the socket. Bytes of a command the kernel took
+    # in part are always completed, a command not started yet is replaced by a newer one.
+    def __init__(self, sock, metrics=None):
+        self.socket = sock
+        self.metrics = metrics
+        self.partial = ""
+        self.partial_time = 0.0
+        self.latest = None
+        self.latest_time = 0.0
+
+        # Counters
+        self.sent = 0
+        self.coalesced = 0
+        self.short_writes = 0
+
+    def write(self, speed, turn, shoot, aim):
+        if self.latest is not None:
+            self.coalesced += 1
+        self.latest = format_command(speed, turn, shoot, aim)
+        self.latest_time = time.time()
+        self.flush()
+
+    def pending(self):
+        return bool(self.partial) or self.latest is not None
+
+    def flush(self):
+        # Hands as much as the kernel takes, call again once the socket is writable.
+        if not self.pending():
+            return
+        data = self.partial + (self.latest or "")
+        try:
+            n = self.socket.send(data, DONTWAIT)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        if n < len(data):
+            self.short_writes += 1
+        rest = n - len(self.partial)
+        if rest < 0:
+            self.partial = self.partial[n:]
+            return
+        if self.partial:
+            self.done(self.partial_time)
+        self.partial = ""
+        if rest > 0:
+            # The latest command is started now and has to be completed.
+            self.partial = self.latest[rest:]
+            self.partial_time = self.latest_time
+            self.latest = None
+            if not self.partial:
+                self.done(self.partial_time)
+
+    def done(self, created):
+        # A command is complete in the kernel buffer.
+        self.sent += 1
+        if self.metrics is not None:
+            self.metrics.record("queued", time.time() - created)
+
+    def stats(self):
+        return {"sent": self.sent, "coalesced": self.coalesced, "short_writes": self.short_writes}
@@ -0,0 +1,83 @@
+import numpy as np
+from player import Player
+
+FIELDS = ("x", "y", "theta", "aim", "movespeed", "turnspeed", "aimspeed", "forget_me", "respawn")
+FORGET_TICKS = 30 * 5
+
+
+class EnemyTracker(object):
+    # Remembers enemies out of sight and dead reckons them. One row per enemy in every array,
+    # the last PlayerState of an enemy is kept for everything the arrays do not track.
+    def __init__(self):
+        self.names = []
+        self.rows = {}
+        self.states = []
+        self.arrays = dict((field, np.zeros(0)) for field in FIELDS)
+
+    def __len__(self):
+        return len(self.names)
+
+    def update(self, raycaster, enemies):
+        a = self.arrays
+        seen = set(enemy.name for enemy in enemies)
+        unseen = np.array([name not in seen for name in self.names], dtype=bool)
+
+        a["forget_me"] -= 1
+        keep = a["forget_me"] > 0
+
+        # Enemies in sight get replaced by their new state below, no need to move them.
+        moving = np.nonzero(keep & unseen & (a["respawn"] == 0))[0]
+        if len(moving):
+            x, y, theta, aim = Player.move_many(raycaster, a["x"][moving], a["y"][moving], a["theta"][moving],
+                                                a["aim"][moving], a["movespeed"][moving], a["turnspeed"][moving],
+                                                a["aimspeed"][moving])
+            a["x"][moving] = x
+            a["y"][moving] = y
+            a["theta"][moving] = theta
+            a["aim"][moving] = aim
+
+        respawning = a["respawn"] > 0
+        a["respawn"][respawning] -= 1
+        keep &= ~(respawning & (a["respawn"] == 0))
+        a["aimspeed"] *= 0.8
+        a["turnspeed"] *= 0.8
+        a["movespeed"] *= 0.99
+
+        if not keep.all():
+            self.compact(keep)
+        for enemy in enemies:
+            self.see(enemy)
+
+    def compact(self, keep):
+        for field in FIELDS:
+            self.arrays[field] = self.arrays[field][keep]
+        rows = np.nonzero(keep)[0].tolist()
+        self.names = [self.names[i] for i in rows]
+        self.states = [self.states[i] for i in rows]
+        self.rows = dict((name, i) for i, name in enumerate(self.names))
+
+    def see(self, enemy):
+        enemy.forget_me = FORGET_TICKS
+        i = self.rows.get(enemy.name)
+        if i is None:
+            i = len(self.names)
+            self.rows[enemy.name] = i
+            self.names.append(enemy.name)
+            self.states.append(enemy)
+            for field in FIELDS:
+                self.arrays[field] = np.append(self.arrays[field], getattr(enemy, field))
+            return
+        self.states[i] = enemy
+        for field in FIELDS:
+            self.arrays[field][i] = getattr(enemy, field)
+
+    def values(self):
+        # The remembered enemies, brought up to date with the arrays.
+        a = self.arrays
+        columns = [a[field].tolist() for field in FIELDS]
+        for state, row in zip(self.states, zip(*columns)):
+            for field, value in zip(FIELDS, row):
+                setattr(state, field, value)
+            state.forget_me = int(state.forget_me)
+            state.respawn = int(state.respawn)
+        return self.states
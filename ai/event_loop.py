@@ -0,0 +1,84 @@
+import select
+import socket
+import traceback
+from log import log as log
+
+RECV_SIZE = 65536
+
+
+class EventLoop(object):
+    # Drives any number of AIs from one thread, each AI handles its newest line as soon as it arrives.
+    # Runs until every AI is gone or the optional stopping event is set.
+    def __init__(self, stopping=None):
+        self.ais = {}
+        self.buffers = {}
+        self.stopping = stopping
+
+    def add(self, ai):
+        fd = ai.socket.fileno()
+        self.ais[fd] = ai
+        self.buffers[fd] = []
+
+    def remove(self, fd):
+        ai = self.ais.pop(fd)
+        del self.buffers[fd]
+        ai.stop()
+        ai.disconnected()
+
+    def run(self):
+        while self.ais:
+            if self.stopping is not None and self.stopping.is_set():
+                self.stop()
+            for fd in [fd for fd, ai in self.ais.items() if not ai.active]:
+                self.remove(fd)
+            if not self.ais:
+                break
+
+            # Commands the kernel did not take at once go out as soon as there is room.
+            waiting = [fd for fd, ai in self.ais.items() if ai.writer.pending()]
+            readable, writable, _ = select.select(list(self.ais), waiting, [], 1.0)
+            for fd in writable:
+                try:
+                    self.ais[fd].writer.flush()
+                except socket.error:
+                    self.remove(fd)
+            for fd in readable:
+                if fd in self.ais:
+                    self.read(fd)
+
+    def read(self, fd):
+        ai = self.ais[fd]
+        try:
+            data = ai.socket.recv(RECV_SIZE)
+        except socket.error as e:
+            # A reset connection takes only this AI out of the loop.
+            log("AI " + str(ai.id) + " lost its connection: " + str(e))
+            self.remove(fd)
+            return
+
+        # Server is shutting down
+        if not data:
+            self.remove(fd)
+            return
+
+        # Only complete lines are handed over and only the newest of them.
+        pending = self.buffers[fd]
+        pending.append(data)
+        if "\n" not in data:
+            return
+        lines = "".join(pending).split("\n")
+        self.buffers[fd] = [lines[-1]]
+        ai.track_tps()
+        if ai.recorder is not None:
+            for line in lines[:-1]:
+                ai.recorder.record(line)
+        ai.mailbox.put(lines[-2], skipped=len(lines) - 2)
+        try:
+            ai.process(ai.mailbox.take(), ai.mailbox.taken_arrival)
+        except Exception:
+            log("AI " + str(ai.id) + " crashed:\n" + traceback.format_exc())
+            self.remove(fd)
+
+    def stop(self):
+        for ai in self.ais.values():
+            ai.stop()
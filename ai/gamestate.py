@@ -0,0 +1,99 @@
+import json
+import re
+from geometry import to_segments
+
+# The walls array in the text of a gamestate, every line of it is two points without brackets.
+WALLS = re.compile(r'"walls"\s*:\s*(\[\s*(?:\[[^\[\]]*\]\s*,?\s*)*\])')
+
+
+class State(object):
+    # Base for the decoded packet objects. Item access keeps code written against the packet dicts working.
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __getstate__(self):
+        return [getattr(self, field) for field in self.__slots__]
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def copy(self):
+        state = self.__class__.__new__(self.__class__)
+        state.__setstate__(self.__getstate__())
+        return state
+
+
+class PlayerState(State):
+    __slots__ = ("name", "x", "y", "theta", "aim", "size", "health", "respawn", "bloom", "shootstate",
+                 "reload_primary", "reload_secondary", "movespeed", "turnspeed", "aimspeed", "forget_me")
+
+    def __init__(self, player):
+        self.name = player["name"]
+        self.x = player["x"]
+        self.y = player["y"]
+        self.theta = player["theta"]
+        self.aim = player["aim"]
+        self.size = player.get("size", 1.0)
+        self.health = player.get("health", 0)
+        self.respawn = player.get("respawn", 0)
+        self.bloom = player.get("bloom", 0.0)
+        self.shootstate = player.get("shootstate", 0)
+        self.reload_primary = player.get("reload_primary", 0)
+        self.reload_secondary = player.get("reload_secondary", 0)
+        self.movespeed = player.get("movespeed", 0.0)
+        self.turnspeed = player.get("turnspeed", 0.0)
+        self.aimspeed = player.get("aimspeed", 0.0)
+        self.forget_me = 0
+
+
+class ProjectileState(State):
+    __slots__ = ("x", "y", "theta", "type", "dead")
+
+    def __init__(self, projectile):
+        self.x = projectile["x"]
+        self.y = projectile["y"]
+        self.theta = projectile.get("theta", 0.0)
+        self.type = projectile.get("type", 1)
+        self.dead = projectile.get("dead", 0)
+
+
+class Gamestate(object):
+    __slots__ = ("player", "players", "projectiles", "walls", "ranking", "remaining_ticks")
+
+    def __init__(self, gamestate, walls=None):
+        self.player = PlayerState(gamestate["player"])
+        self.players = [PlayerState(p) for p in gamestate["players"]]
+        self.projectiles = [ProjectileState(p) for p in gamestate["projectiles"]]
+        self.walls = to_segments(gamestate["walls"]) if walls is None else walls
+        self.ranking = gamestate["ranking"]
+        self.remaining_ticks = gamestate["remaining_ticks"]
+
+
+
+class Decoder(object):
+    # Decodes the lines of one connection. The server sends the same walls every tick: while the text of
+    # the walls equals the last one it is cut out before parsing and the last segments object is reused,
+    # so the walls are neither parsed, compared nor converted again.
+    def __init__(self):
+        self.walls_text = None
+        self.segments = None
+
+    def decode(self, line):
+        # Returns the packet and its Gamestate, None for packets without one.
+        match = WALLS.search(line)
+        if match is not None and match.group(1) == self.walls_text:
+            packet = json.loads(line[:match.start(1)] + "[]" + line[match.end(1):])
+            if "gamestate" in packet:
+                return packet, Gamestate(packet["gamestate"], self.segments)
+        packet = json.loads(line)
+        if "gamestate" not in packet:
+            return packet, None
+        self.walls_text = match.group(1) if match is not None else None
+        self.segments = to_segments(packet["gamestate"]["walls"])
+        return packet, Gamestate(packet["gamestate"], self.segments)
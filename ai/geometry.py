@@ -0,0 +1,243 @@
+from __future__ import division
+import hashlib
+import math
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from segment_grid import SegmentGrid
+from clearance import ClearanceField
+import clearance
+import segment_grid
+from geometry_store import attach, publish, remove
+
+# Below this many static segments a plain broadcast beats walking the grid. Measured with benchmark.py --grid,
+# the grid wins from 5000 to 7000 segments depending on the rays per call. Game maps stay far below, a map of
+# 40 walls has 176 rect segments, the grid only serves much larger maps.
+GRID_MIN_SEGMENTS = 6000
+MAX_CACHED_MAPS = 8
+
+# Bump when the stored arrays change their meaning or layout. Together with the build parameters it is part
+# of the stored name, geometry built by another version or with other settings is never attached.
+STORE_VERSION = 1
+
+
+class WallGeometry(object):
+    # Everything derived from the walls of a map. Built once and shared read only.
+    # The walls are given as (N, 4) array of x0, y0, x1, y1 or as the line list of the packets.
+    # The arrays of get_arrays for the same walls, passed as stored, skip building them again.
+    def __init__(self, walls, key=None, stored=None):
+        segments = as_segments(walls)
+        self.key = key if key is not None else geometry_key(segments)
+        self.map_size = 0
+        for x0, y0, x1, y1 in segments.tolist():
+            self.map_size = max(self.map_size, 2 * abs(x0), 2 * abs(y0), 2 * abs(x1), 2 * abs(y1))
+        if stored is None:
+            lines_as_rects = []
+            for x0, y0, x1, y1 in segments.tolist():
+                dx = x0 - x1
+                dy = y0 - y1
+                mx = (x0 + x1) / 2
+                my = (y0 + y1) / 2
+                mlen = math.sqrt(dx*dx+dy*dy)
+                mtheta = math.atan2(dy, dx)
+                create_rect(lines_as_rects, mx, my, mlen + 1, 1, mtheta)
+            rect_segments = to_segments(lines_as_rects)
+            stored = {}
+        else:
+            rect_segments = stored["rect_segments"]
+
+        # Static segments as (N, 4) arrays of x0, y0, x1, y1
+        self.wall_segments = segments
+        self.rect_segments = rect_segments
+        self.wall_grid = create_grid(self.wall_segments, stored_index(stored, "wall_grid", 2))
+        self.rect_grid = create_grid(self.rect_segments, stored_index(stored, "rect_grid", 2))
+        # Guards the parts built on first use, threads asking meanwhile wait instead of building their own.
+        self.lock = Lock()
+        self.walls = None
+        self.lines_as_rects = None
+        self.sweep_segments = None
+        self.clearance = None
+        index = stored_index(stored, "clearance", 3)
+        if index is not None:
+            self.clearance = ClearanceField(self.rect_segments, index=index)
+
+    def get_walls(self):
+        # The walls as line list of the packets, built on first use. Only drawing needs it.
+        if self.walls is None:
+            with self.lock:
+                if self.walls is None:
+                    self.walls = to_lines(self.wall_segments)
+        return self.walls
+
+    def get_lines_as_rects(self):
+        # The collision rects as line list, built on first use.
+        if self.lines_as_rects is None:
+            with self.lock:
+                if self.lines_as_rects is None:
+                    self.lines_as_rects = to_lines(self.rect_segments)
+        return self.lines_as_rects
+
+    def get_sweep_segments(self):
+        # Walls split where they cross each other, built on first use.
+        if self.sweep_segments is None:
+            with self.lock:
+                if self.sweep_segments is None:
+                    self.sweep_segments = split_segments(self.wall_segments, self.wall_segments)
+        return self.sweep_segments
+
+    def get_clearance(self):
+        # Clearance field of the collision rects, built on first use.
+        if self.clearance is None:
+            with self.lock:
+                if self.clearance is None:
+                    self.clearance = ClearanceField(self.rect_segments)
+        return self.clearance
+
+    def get_arrays(self):
+        # Everything built from the walls as named arrays, see stored.
+        arrays = {"rect_segments": self.rect_segments}
+        parts = [("clearance", self.get_clearance()), ("wall_grid", self.wall_grid), ("rect_grid", self.rect_grid)]
+        for name, part in parts:
+            if part is not None:
+                for i, array in enumerate(part.get_arrays()):
+                    arrays[name + "_" + str(i)] = array
+        return arrays
+
+
+def stored_index(stored, name, count):
+    names = [name + "_" + str(i) for i in range(count)]
+    if names[0] not in stored:
+        return None
+    return tuple(stored[n] for n in names)
+
+
+def create_rect(lines, x, y, width, height, theta):
+    dx_width = math.cos(theta) * width
+    dy_width = math.sin(theta) * width
+    dx_height = math.sin(theta) * height
+    dy_height = math.cos(theta) * height
+
+    ul = {"x": x + dx_width/2 - dx_height / 2, "y": y + dy_height / 2 + dy_width / 2}
+    ur = {"x": x - dx_width/2 - dx_height / 2, "y": y + dy_height / 2 - dy_width / 2}
+    bl = {"x": x + dx_width/2 + dx_height / 2, "y": y - dy_height / 2 + dy_width / 2}
+    br = {"x": x - dx_width/2 + dx_height / 2, "y": y - dy_height / 2 - dy_width / 2}
+
+    lines.append([ul, ur])
+    lines.append([ur, br])
+    lines.append([br, bl])
+    lines.append([bl, ul])
+
+
+def to_segments(lines):
+    segments = [[line[0]["x"], line[0]["y"], line[1]["x"], line[1]["y"]] for line in lines]
+    segments = np.array(segments, dtype=float).reshape(-1, 4)
+    segments.flags.writeable = False
+    return segments
+
+
+def as_segments(walls):
+    if isinstance(walls, np.ndarray):
+        segments = np.array(walls, dtype=float).reshape(-1, 4)
+        segments.flags.writeable = False
+        return segments
+    return to_segments(walls)
+
+
+def to_lines(segments):
+    return [[{"x": x0, "y": y0}, {"x": x1, "y": y1}] for x0, y0, x1, y1 in segments.tolist()]
+
+
+def split_segments(segments, others, rows=256):
+    # Splits every segment at the points where it crosses one of the others.
+    result = []
+    ox = others[:, 0]
+    oy = others[:, 1]
+    oex = others[:, 2] - ox
+    oey = others[:, 3] - oy
+    for first in range(0, len(segments), rows):
+        chunk = segments[first:first + rows]
+        x0 = chunk[:, 0:1]
+        y0 = chunk[:, 1:2]
+        ex = chunk[:, 2:3] - x0
+        ey = chunk[:, 3:4] - y0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            denom = ex * oey - ey * oex
+            u = ((ox - x0) * oey - (oy - y0) * oex) / denom
+            v = ((ox - x0) * ey - (oy - y0) * ex) / denom
+            crossing = (denom != 0) & (u > 0) & (u < 1) & (v >= 0) & (v <= 1)
+        for i, row in enumerate(chunk.tolist()):
+            if not crossing[i].any():
+                result.append(row)
+                continue
+            x, y = row[0], row[1]
+            for t in sorted(set(u[i][crossing[i]].tolist())):
+                nx = row[0] + (row[2] - row[0]) * t
+                ny = row[1] + (row[3] - row[1]) * t
+                result.append([x, y, nx, ny])
+                x, y = nx, ny
+            result.append([x, y, row[2], row[3]])
+    return np.array(result, dtype=float).reshape(-1, 4)
+
+
+def create_grid(segments, index=None):
+    if len(segments) < GRID_MIN_SEGMENTS:
+        return None
+    return SegmentGrid(segments, index=index)
+
+
+def geometry_key(segments):
+    return hashlib.sha1(np.ascontiguousarray(segments, dtype=float).tobytes()).hexdigest()
+
+
+_cache = OrderedDict()
+_cache_lock = Lock()
+_shared_directory = None
+_published = []
+
+
+def share_geometry(directory):
+    # Publish the geometry built in this process into directory and attach to the geometry other
+    # processes published there instead of building it. None stops sharing.
+    global _shared_directory
+    _shared_directory = directory
+
+
+def release_geometry():
+    # Removes the geometry this process published, call on shutdown.
+    while _published:
+        remove(_published.pop())
+
+
+def store_key(key):
+    params = (STORE_VERSION, GRID_MIN_SEGMENTS, segment_grid.MAX_CELLS_PER_AXIS, segment_grid.CELL_PADDING,
+              clearance.CELL_SIZE, clearance.MAX_CELLS_PER_AXIS, clearance.MAX_CLEARANCE, clearance.REACH_CELLS)
+    return "v" + str(STORE_VERSION) + "-" + hashlib.sha1(repr(params).encode()).hexdigest()[:12] + "-" + key
+
+
+def load_geometry(segments, key):
+    directory = _shared_directory
+    if directory is None:
+        return WallGeometry(segments, key)
+    name = store_key(key)
+    stored = attach(directory, name)
+    if stored is not None:
+        return WallGeometry(segments, key, stored)
+    geometry = WallGeometry(segments, key)
+    path = publish(directory, name, geometry.get_arrays())
+    if path is not None:
+        _published.append(path)
+    return geometry
+
+
+def get_geometry(walls):
+    # Returns the shared geometry for these walls, building it on first use.
+    segments = as_segments(walls)
+    key = geometry_key(segments)
+    with _cache_lock:
+        geometry = _cache.pop(key, None)
+        if geometry is None:
+            geometry = load_geometry(segments, key)
+        _cache[key] = geometry
+        while len(_cache) > MAX_CACHED_MAPS:
+            _cache.popitem(last=False)
+        return geometry
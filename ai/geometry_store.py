@@ -0,0 +1,59 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+PREFIX = "into-darkness-geometry-"
+INDEX = "index.json"
+
+
+def default_directory():
+    # Memory backed on Linux, attached arrays then share the page cache of the published files.
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def publish(directory, key, arrays):
+    # Stores the named arrays under key, unless another process already did. Returns the path if this call
+    # stored them, the caller removes it again.
+    path = os.path.join(directory, PREFIX + key)
+    if os.path.isdir(path):
+        return None
+    tmp = None
+    try:
+        # Written aside and renamed, a directory under the final name is always complete.
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=directory)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), np.ascontiguousarray(array))
+        with open(os.path.join(tmp, INDEX), "w") as f:
+            json.dump(sorted(arrays), f)
+        os.rename(tmp, path)
+        return path
+    except (IOError, OSError):
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return None
+
+
+def attach(directory, key):
+    # The arrays stored under key as read only views of the mapped files, None if nothing is stored.
+    path = os.path.join(directory, PREFIX + key)
+    try:
+        with open(os.path.join(path, INDEX)) as f:
+            names = json.load(f)
+        return dict((str(name), load(os.path.join(path, name + ".npy"))) for name in names)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def load(path):
+    try:
+        return np.asarray(np.load(path, mmap_mode="r"))
+    except ValueError:
+        # Empty arrays cannot be mapped.
+        return np.load(path)
+
+
+def remove(path):
+    # Processes that attached keep their mapping, later ones build the geometry again.
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,52 @@
+import time
+from threading import Condition
+
+
+class Mailbox(object):
+    # Single slot for the newest raw line. Older lines are overwritten without ever being parsed.
+    def __init__(self):
+        self.condition = Condition()
+        self.line = None
+        self.arrival = 0.0
+        self.taken_arrival = 0.0
+        self.closed = False
+
+        # Counters
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.staleness = 0.0
+        self.max_staleness = 0.0
+
+    def put(self, line, skipped=0):
+        with self.condition:
+            self.received += 1 + skipped
+            self.dropped += skipped
+            if self.line is not None:
+                self.dropped += 1
+            self.line = line
+            self.arrival = time.time()
+            self.condition.notify()
+
+    def take(self):
+        # Blocks until a line arrives, returns None once the mailbox is closed.
+        with self.condition:
+            while self.line is None and not self.closed:
+                self.condition.wait()
+            line = self.line
+            self.line = None
+            if line is not None:
+                self.processed += 1
+                self.taken_arrival = self.arrival
+                self.staleness = time.time() - self.arrival
+                self.max_staleness = max(self.max_staleness, self.staleness)
+            return line
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        return {"received": self.received, "processed": self.processed, "dropped": self.dropped,
+                "staleness": self.staleness, "max_staleness": self.max_staleness}
@@ -0,0 +1,92 @@
+from __future__ import division
+import time
+from collections import OrderedDict, deque
+
+PERCENTILES = (50, 95, 99)
+
+
+class RollingHistogram(object):
+    # Keeps the last `size` samples, recording is O(1) and percentiles are computed when asked for.
+    def __init__(self, size=1024):
+        self.size = size
+        self.samples = []
+        self.index = 0
+        self.count = 0
+
+    def record(self, value):
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            self.samples[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count += 1
+
+    def percentiles(self, percentiles=PERCENTILES):
+        samples = sorted(self.samples)
+        if not samples:
+            return [0.0 for _ in percentiles]
+        return [samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))] for p in percentiles]
+
+    def max(self):
+        return max(self.samples) if self.samples else 0.0
+
+    def summary(self, scale=1000.0, unit="ms"):
+        p50, p95, p99 = [p * scale for p in self.percentiles()]
+        return "p50=%.2f%s p95=%.2f%s p99=%.2f%s max=%.2f%s n=%d" % (
+            p50, unit, p95, unit, p99, unit, self.max() * scale, unit, self.count)
+
+
+class RateCounter(object):
+    # Running total and the throughput over the last `window` seconds, kept in one bucket per second.
+    # Reading changes nothing, any number of readers see the same rate.
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self.buckets = deque()
+        self.start = time.time()
+
+    def add(self, amount=1):
+        self.total += amount
+        second = int(time.time())
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += amount
+        else:
+            self.buckets.append([second, amount])
+            while self.buckets[0][0] <= second - self.window:
+                self.buckets.popleft()
+
+    def rate(self):
+        # Over the whole seconds in the window up to now, at least one second.
+        now = time.time()
+        first = int(now) - self.window + 1
+        amount = sum(a for second, a in self.buckets if second >= first)
+        return amount / max(now - max(first, self.start), 1.0)
+
+
+class TickMetrics(object):
+    # Rolling timings for every stage of a pipeline. start() opens a tick, lap() closes the current stage.
+    def __init__(self, stages, size=1024):
+        self.histograms = OrderedDict((stage, RollingHistogram(size)) for stage in stages)
+        self.arrival = 0.0
+        self.last = 0.0
+
+    def start(self, arrival=None):
+        self.last = time.time()
+        self.arrival = arrival if arrival is not None else self.last
+
+    def lap(self, stage):
+        now = time.time()
+        self.histograms[stage].record(now - self.last)
+        self.last = now
+
+    def since_arrival(self, stage):
+        self.histograms[stage].record(time.time() - self.arrival)
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    def get(self):
+        return OrderedDict((stage, h.percentiles()) for stage, h in self.histograms.items())
+
+    def report(self):
+        return "\n".join("  %-22s %s" % (stage, h.summary()) for stage, h in self.histograms.items() if h.count)
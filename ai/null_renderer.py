@@ -0,0 +1,7 @@
+class NullRenderer(object):
+    # Renderer for AIs nobody watches, every call is a no-op.
+    def get_selected_player(self):
+        return -1
+
+    def publish(self, snapshot):
+        pass
@@ -1,10 +1,21 @@
 import math
+import numpy as np
 
 AIMSPEED_PER_TICK = 1.5 * math.radians(90/30)
 TURNSPEED_PER_TICK = math.radians(90/30)
 MOVESPEED_PER_TICK = 0.2
 
 
+def normalize_angles(theta):
+    # Wraps into (-pi, pi] like the while loops in move. One wrap is exact, larger jumps fall back to a modulo.
+    theta = np.where(theta <= -math.pi, theta + 2 * math.pi, theta)
+    theta = np.where(theta > math.pi, theta - 2 * math.pi, theta)
+    outside = (theta <= -math.pi) | (theta > math.pi)
+    if outside.any():
+        theta[outside] = math.pi - np.mod(math.pi - theta[outside], 2 * math.pi)
+    return theta
+
+
 class Player(object):
     def __init__(self, raycaster):
         pass
@@ -51,4 +62,21 @@ class Player(object):
         while pose["aim"] <= -math.pi:
             pose["aim"] += 2 * math.pi
         while pose["aim"] > math.pi:
-            pose["aim"] -= 2 * math.pi
\ No newline at end of file
+            pose["aim"] -= 2 * math.pi
+
+    @staticmethod
+    def move_many(raycaster, x, y, theta, aim, movespeed, turnspeed, aimspeed):
+        # move for arrays of poses with one batched cast, returns the new x, y, theta and aim.
+        dx = np.cos(theta) * movespeed * MOVESPEED_PER_TICK
+        dy = np.sin(theta) * movespeed * MOVESPEED_PER_TICK
+
+        # Check how far the robots can move and crop where an obstacle is in the way.
+        direction = np.where(movespeed >= 0, theta, theta - math.pi)
+        _, dist, hits = raycaster.cast_many(np.column_stack((x, y)), direction, collision_mode=True)
+        blocked = (hits >= 0) & (dist * dist <= dx * dx + dy * dy * 1.01)
+        dx = np.where(blocked, 0.0, dx)
+        dy = np.where(blocked, 0.0, dy)
+
+        theta = normalize_angles(theta + turnspeed * TURNSPEED_PER_TICK)
+        aim = normalize_angles(aim + aimspeed * AIMSPEED_PER_TICK + turnspeed * TURNSPEED_PER_TICK)
+        return x + dx, y + dy, theta, aim
@@ -1,153 +1,225 @@
 from __future__ import division
-import math
 import numpy as np
+from clearance import nearest_hit
+from geometry import to_lines
 
-
-class LineIntersector(object):
-    def perp(self, a):
-        b = np.empty_like(a)
-        b[0] = -a[1]
-        b[1] = a[0]
-        return b
-
-    def pretest(self, x1, y1, x2, y2, x3, y3, x4, y4):
-        if x1 < x3 and x2 < x3 and x1 < x4 and x2 < x4:
-            return False
-        if x1 > x3 and x2 > x3 and x1 > x4 and x2 > x4:
-            return False
-        if y1 < y3 and y2 < y3 and y1 < y4 and y2 < y4:
-            return False
-        if y1 > y3 and y2 > y3 and y1 > y4 and y2 > y4:
-            return False
-
-        return True
-
-    def seg_intersect(self, a1, a2, b1, b2):
-        da = a2-a1
-        db = b2-b1
-        dp = a1-b1
-        dap = self.perp(da)
-        dbp = self.perp(db)
-        denom = np.dot(dap, db)
-        num = np.dot(dap, dp)
-
-        denom2 = np.dot(dbp, da)
-        num2 = np.dot(dbp, -dp)
-
-        if denom == 0 or denom2 == 0:
-            return None
-        s = (num / denom)
-        s2 = (num2 / denom2)
-        if 0 <= s <= 1 and 0 <= s2 <= 1:
-            return b1 + s * db
-        return None
+# The two crosses of a player as x0, y0, x1, y1 offsets from its center in half sizes.
+CORNER_COLUMNS = [0, 1, 0, 1]
+CORNER_SIGNS = np.array([[-1.0, -1.0, 1.0, 1.0], [-1.0, 1.0, 1.0, -1.0]])
 
 
 class Raycaster(object):
-    def __init__(self, map):
-        self.players = None
-        self.lines = list(map)
-        self.map = map
-        self.line_intersector = LineIntersector()
-        self.map_size = 0
-        self.lines_as_rects = []
-        for line in self.lines:
-            dx = line[0]["x"] - line[1]["x"]
-            dy = line[0]["y"] - line[1]["y"]
-            mx = (line[0]["x"] + line[1]["x"]) / 2
-            my = (line[0]["y"] + line[1]["y"]) / 2
-            mlen = math.sqrt(dx*dx+dy*dy)
-            mtheta = math.atan2(dy, dx)
-            self.create_rect(self.lines_as_rects, mx, my, mlen + 1, 1, mtheta)
-            self.map_size = max(self.map_size, 2 * abs(line[0]["x"]))
-            self.map_size = max(self.map_size, 2 * abs(line[0]["y"]))
-            self.map_size = max(self.map_size, 2 * abs(line[1]["x"]))
-            self.map_size = max(self.map_size, 2 * abs(line[1]["y"]))
-
-    def create_rect(self, lines, x, y, width, height, theta):
-        dx_width = math.cos(theta) * width
-        dy_width = math.sin(theta) * width
-        dx_height = math.sin(theta) * height
-        dy_height = math.cos(theta) * height
-
-        ul = {"x": x + dx_width/2 - dx_height / 2, "y": y + dy_height / 2 + dy_width / 2}
-        ur = {"x": x - dx_width/2 - dx_height / 2, "y": y + dy_height / 2 - dy_width / 2}
-        bl = {"x": x + dx_width/2 + dx_height / 2, "y": y - dy_height / 2 + dy_width / 2}
-        br = {"x": x - dx_width/2 + dx_height / 2, "y": y - dy_height / 2 - dy_width / 2}
-
-        lines.append([ul, ur])
-        lines.append([ur, br])
-        lines.append([br, bl])
-        lines.append([bl, ul])
-        
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.players = []
+        self.map_size = geometry.map_size
+
+        # Static layers are shared, the player crosses are our own.
+        self.wall_segments = geometry.wall_segments
+        self.rect_segments = geometry.rect_segments
+        self.wall_grid = geometry.wall_grid
+        self.rect_grid = geometry.rect_grid
+        self.player_index = {}
+        self.cross_buffer = np.empty((0, 4))
+        self.owner_buffer = np.empty(0, dtype=int)
+        self.crosses = self.cross_buffer
+        self.cross_owners = self.owner_buffer
+        self.casts = 0
+
+    def get_map(self):
+        return self.geometry.get_walls()
+
     def get_lines_as_rects(self):
-        return self.lines_as_rects
-        
+        return self.geometry.get_lines_as_rects()
+
     def get_map_size(self):
         return self.map_size
 
     def update(self, players):
+        # Only the dynamic layer changes, two crosses per player written into reused buffers.
         self.players = players
-        self.lines = list(self.map)
-        self.lines_with_rects = list(self.lines_as_rects)
-        for player in self.players:
-            p = player
-            x3 = p["x"] - p["size"] / 2.0
-            y3 = p["y"] - p["size"] / 2.0
-            x4 = p["x"] + p["size"] / 2.0
-            y4 = p["y"] + p["size"] / 2.0
-            self.lines.append([{"x": x3, "y": y3}, {"x": x4, "y": y4}, p])
-            self.lines.append([{"x": x3, "y": y4}, {"x": x4, "y": y3}, p])
-            self.lines_with_rects.append([{"x": x3, "y": y3}, {"x": x4, "y": y4}, p])
-            self.lines_with_rects.append([{"x": x3, "y": y4}, {"x": x4, "y": y3}, p])
+        self.player_index = dict((p.name, i) for i, p in enumerate(players))
+        n = 2 * len(players)
+        if len(self.cross_buffer) < n:
+            capacity = max(n, 2 * len(self.cross_buffer))
+            self.cross_buffer = np.empty((capacity, 4))
+            self.owner_buffer = np.repeat(np.arange(capacity // 2), 2)
+        if players:
+            poses = np.array([(p.x, p.y, p.size / 2.0) for p in players], dtype=float)
+            crosses = self.cross_buffer[:n].reshape(-1, 2, 4)
+            crosses[:] = poses[:, None, CORNER_COLUMNS] + poses[:, None, 2:3] * CORNER_SIGNS
+        self.crosses = self.cross_buffer[:n]
+        self.cross_owners = self.owner_buffer[:n]
+
+    def get_cross_lines(self):
+        lines = []
+        for (x0, y0, x1, y1), owner in zip(self.crosses.tolist(), self.cross_owners.tolist()):
+            lines.append([{"x": x0, "y": y0}, {"x": x1, "y": y1}, self.players[owner]])
+        return lines
 
     def get_lines(self):
-        return self.lines
-
-    def cast(self, ray, leave_out_player=None, collision_mode=False):
-        # Vision ray line
-        x1 = ray["x"]
-        y1 = ray["y"]
-        p1 = np.array([x1, y1])
-        x2 = x1 + math.cos(ray["theta"]) * self.map_size * 1.5
-        y2 = y1 + math.sin(ray["theta"]) * self.map_size * 1.5
-        p2 = np.array([x2, y2])
-        closest = None
-        closest_obj = None
-        lines = self.lines
-        if collision_mode:
-            lines = self.lines_with_rects
-        for line in lines:
-            if len(line) == 3 and line[2]["name"] == leave_out_player:
-                continue
+        # Built on request only, casts never need it.
+        return list(self.get_map()) + self.get_cross_lines()
 
-            # Line
-            x3 = line[0]["x"]
-            y3 = line[0]["y"]
-            x4 = line[1]["x"]
-            y4 = line[1]["y"]
+    def get_hit_object(self, index, collision_mode=False):
+        # Walls as a line of the packets, built for the one hit instead of keeping all lines around.
+        static = self.rect_segments if collision_mode else self.wall_segments
+        if index < len(static):
+            return to_lines(static[index:index + 1])[0]
+        return self.players[self.cross_owners[index - len(static)]]
 
-            if not self.line_intersector.pretest(x1, y1, x2, y2, x3, y3, x4, y4):
-                continue
-            intersection = self.line_intersector.seg_intersect(p1, p2, np.array([x3, y3]), np.array([x4, y4]))
-            if intersection is None:
+    def cast(self, ray, leave_out_player=None, collision_mode=False):
+        points, _, indices = self.cast_many([(ray["x"], ray["y"])], [ray["theta"]], leave_out_player, collision_mode)
+        if indices[0] < 0:
+            return None, None, None
+        return points[0, 0], points[0, 1], self.get_hit_object(indices[0], collision_mode)
+
+    def cast_many(self, origins, thetas, leave_out=None, collision_mode=False):
+        # Returns hit points (nan on miss), distances (inf on miss) and indices (-1 on miss) for every ray.
+        # Indices below the static segment count are walls, the rest are player crosses (see get_hit_object).
+        origins, points, d2, indices, dax, day, length = self.prepare(origins, thetas)
+        static = self.rect_segments if collision_mode else self.wall_segments
+        grid = self.rect_grid if collision_mode else self.wall_grid
+        if len(d2):
+            self.cast_static(static, grid, origins, dax, day, length, points, d2, indices)
+            self.cast_dynamic(origins, dax, day, leave_out, points, d2, indices, len(static))
+        return points, np.sqrt(d2), indices
+
+    def free_distance(self, origins, thetas, leave_out=None):
+        # Same results as cast_many(..., collision_mode=True). The rects are found by sphere tracing over the
+        # clearance field and exact tests against the rects near the ray where it gets close. Meant for a
+        # few probes, everything runs on plain floats.
+        origins, points, d2, indices, dax, day, length = self.prepare(origins, thetas)
+        clearance = self.geometry.get_clearance()
+        offset = len(self.rect_segments)
+        crosses = self.crosses.tolist()
+        skip = self.player_index.get(leave_out, -1) if leave_out is not None else -1
+        owners = self.cross_owners.tolist()
+        ids = [k for k in range(len(crosses)) if owners[k] != skip]
+        rows = [crosses[k] for k in ids]
+        fallback = []
+        for i, (x, y, dx, dy) in enumerate(zip(origins[:, 0].tolist(), origins[:, 1].tolist(),
+                                               dax.tolist(), day.tolist())):
+            best = clearance.trace(x, y, dx, dy, length)
+            if best is None:
+                fallback.append(i)
                 continue
-            if closest is None:
-                closest = intersection
-                closest_obj = line
-            else:
-                dx1 = x1 - intersection[0]
-                dx0 = x1 - closest[0]
-                dy1 = y1 - intersection[1]
-                dy0 = y1 - closest[1]
-                if dx0 * dx0 + dy0 * dy0 > dx1 * dx1 + dy1 * dy1:
-                    closest = intersection
-                    closest_obj = line
-
-        if closest is not None:
-            if len(closest_obj) > 2:
-                return closest[0], closest[1], closest_obj[2]
-            else:
-                return closest[0], closest[1], closest_obj
+            hit = nearest_hit(x, y, dx, dy, ids, rows, best)
+            if hit[3] >= 0:
+                d2[i] = hit[0]
+                points[i] = hit[1:3]
+                indices[i] = hit[3] + (offset if hit is not best else 0)
+
+        if fallback:
+            rows = np.array(fallback)
+            sub_points = points[rows]
+            sub_d2 = d2[rows]
+            sub_indices = indices[rows]
+            self.cast_static(self.rect_segments, self.rect_grid, origins[rows], dax[rows], day[rows], length,
+                             sub_points, sub_d2, sub_indices)
+            mask = None
+            if skip >= 0:
+                mask = self.cross_owners != skip
+            self.closest_hits(origins[rows], dax[rows], day[rows], self.crosses, mask,
+                              sub_points, sub_d2, sub_indices, offset)
+            points[rows] = sub_points
+            d2[rows] = sub_d2
+            indices[rows] = sub_indices
+        return points, np.sqrt(d2), indices
+
+    def prepare(self, origins, thetas):
+        origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+        thetas = np.asarray(thetas, dtype=float).reshape(-1)
+        n = len(thetas)
+        self.casts += n
+        points = np.full((n, 2), np.nan)
+        d2 = np.full(n, np.inf)
+        indices = np.full(n, -1, dtype=int)
+
+        # Vision ray lines
+        length = self.map_size * 1.5
+        dax = np.cos(thetas) * length
+        day = np.sin(thetas) * length
+        return origins, points, d2, indices, dax, day, length
+
+    def cast_static(self, static, grid, origins, dax, day, length, points, d2, indices):
+        # Static layer, either through the grid or as one broadcast.
+        if grid is None:
+            self.closest_hits(origins, dax, day, static, None, points, d2, indices, 0)
         else:
-            return None, None, None
+            for i in range(len(origins)):
+                self.cast_grid(grid, origins[i], dax[i], day[i], length, points[i], d2[i:i + 1], indices[i:i + 1])
+
+    def cast_dynamic(self, origins, dax, day, leave_out, points, d2, indices, offset):
+        # Dynamic layer, players are few so always broadcast.
+        mask = None
+        if leave_out is not None and leave_out in self.player_index:
+            mask = self.cross_owners != self.player_index[leave_out]
+        self.closest_hits(origins, dax, day, self.crosses, mask, points, d2, indices, offset)
+
+    def cast_grid(self, grid, origin, dax, day, length, point, d2, index):
+        # Walks the grid cells along the ray and stops as soon as the nearest hit lies in the visited cells.
+        chunk = []
+        budget = 2
+        for cell, t_exit in grid.traverse(origin[0], origin[1], dax / length, day / length, length):
+            chunk.append(grid.get_cell(cell))
+            if len(chunk) < budget:
+                continue
+            self.test_cells(grid, chunk, origin, dax, day, point, d2, index)
+            if d2[0] < t_exit * t_exit:
+                return
+            # Keep the best hit so far as candidate, equal distances then resolve to the lower index.
+            chunk = [index.copy()] if index[0] >= 0 else []
+            budget *= 2
+        if chunk:
+            self.test_cells(grid, chunk, origin, dax, day, point, d2, index)
+
+    @classmethod
+    def test_cells(cls, grid, chunk, origin, dax, day, point, d2, index):
+        candidates = np.unique(np.concatenate(chunk))
+        d2[0] = np.inf
+        cls.closest_hits(origin[None, :], np.array([dax]), np.array([day]), grid.segments[candidates], None,
+                         point[None, :], d2, index, 0)
+        if index[0] >= 0:
+            index[0] = candidates[index[0]]
+
+    @staticmethod
+    def closest_hits(origins, dax, day, segments, mask, points, d2, indices, offset):
+        # Intersects all rays with all segments at once and keeps hits closer than d2.
+        if len(segments) == 0:
+            return
+        x1 = origins[:, 0:1]
+        y1 = origins[:, 1:2]
+        dax = dax[:, None]
+        day = day[:, None]
+
+        # Segment lines
+        x3 = segments[:, 0]
+        y3 = segments[:, 1]
+        dbx = segments[:, 2] - x3
+        dby = segments[:, 3] - y3
+        dpx = x1 - x3
+        dpy = y1 - y3
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            denom = -day * dbx + dax * dby
+            s = (-day * dpx + dax * dpy) / denom
+            s2 = (dby * dpx - dbx * dpy) / -denom
+            hx = x3 + s * dbx
+            hy = y3 + s * dby
+            valid = (denom != 0) & (s >= 0) & (s <= 1) & (s2 >= 0) & (s2 <= 1)
+        if mask is not None:
+            valid &= mask
+
+        dx = x1 - hx
+        dy = y1 - hy
+        dist = np.where(valid, dx * dx + dy * dy, np.inf)
+        closest = np.argmin(dist, axis=1)
+        rows = np.arange(len(origins))
+        closest_d2 = dist[rows, closest]
+        hit = closest_d2 < d2
+
+        points[hit, 0] = hx[rows, closest][hit]
+        points[hit, 1] = hy[rows, closest][hit]
+        d2[hit] = closest_d2[hit]
+        indices[hit] = closest[hit] + offset
@@ -0,0 +1,23 @@
+import os
+from threading import Lock
+
+
+class Recorder(object):
+    # Appends raw lines as received from the server to a file, one line per packet.
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Line buffered, a killed AI still leaves a usable recording.
+        self.file = open(path, "a", 1)
+        self.lock = Lock()
+
+    def record(self, line):
+        # Lines still arriving after close are dropped.
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
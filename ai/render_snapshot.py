@@ -0,0 +1,23 @@
+from collections import namedtuple
+
+# Lobby countdown shown until the server sends one.
+INIT_TIMEOUT = 30 * 30
+
+# Everything the UI draws for one tick. Built by the AI that renders, handed over as a whole, never changed after.
+# map_key is the geometry key of the walls, the UI keeps its raycaster while it stays the same.
+RenderSnapshot = namedtuple("RenderSnapshot", ("lobby", "timeout", "player", "players", "projectiles", "map_key",
+                                               "walls", "ranking", "remaining_ticks"))
+
+EMPTY = RenderSnapshot(True, INIT_TIMEOUT, None, (), (), None, None, None, 0)
+
+
+def game_snapshot(player, players, projectiles, map_key, walls, ranking, remaining_ticks):
+    # Copies the states the enemy tracker keeps changing, the rest of a decoded tick is not touched after decoding.
+    players = tuple(p.copy() for p in players)
+    return RenderSnapshot(False, INIT_TIMEOUT, player.copy(), players, tuple(projectiles), map_key, walls,
+                          dict(ranking), remaining_ticks)
+
+
+def lobby_snapshot(previous, timeout):
+    # The lobby keeps showing the ranking of the last game.
+    return (previous or EMPTY)._replace(lobby=True, timeout=timeout)
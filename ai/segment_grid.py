@@ -0,0 +1,117 @@
+from __future__ import division
+import math
+import numpy as np
+
+MAX_CELLS_PER_AXIS = 128
+CELL_PADDING = 1e-6
+
+
+class SegmentGrid(object):
+    def __init__(self, segments, cells=None, index=None):
+        self.segments = segments
+        if cells is None:
+            cells = max(1, min(MAX_CELLS_PER_AXIS, int(math.sqrt(len(segments)))))
+        self.nx = cells
+        self.ny = cells
+
+        # Bounding box of all segments
+        if len(segments) > 0:
+            self.min_x = min(segments[:, 0].min(), segments[:, 2].min())
+            self.min_y = min(segments[:, 1].min(), segments[:, 3].min())
+            self.max_x = max(segments[:, 0].max(), segments[:, 2].max())
+            self.max_y = max(segments[:, 1].max(), segments[:, 3].max())
+        else:
+            self.min_x = self.min_y = self.max_x = self.max_y = 0.0
+        self.cell_w = max(self.max_x - self.min_x, CELL_PADDING) / self.nx
+        self.cell_h = max(self.max_y - self.min_y, CELL_PADDING) / self.ny
+
+        if index is not None:
+            # Built before, e.g. by another process (see get_arrays).
+            self.cell_start, self.cell_items = index
+        else:
+            self.build()
+        self.cell_start.flags.writeable = False
+        self.cell_items.flags.writeable = False
+
+    def build(self):
+        # Bucket every segment into the cells its bounding box touches
+        buckets = [[] for _ in range(self.nx * self.ny)]
+        for i, (x0, y0, x1, y1) in enumerate(self.segments.tolist()):
+            cx0 = self.cell_x(min(x0, x1) - CELL_PADDING)
+            cx1 = self.cell_x(max(x0, x1) + CELL_PADDING)
+            cy0 = self.cell_y(min(y0, y1) - CELL_PADDING)
+            cy1 = self.cell_y(max(y0, y1) + CELL_PADDING)
+            for cy in range(cy0, cy1 + 1):
+                for cx in range(cx0, cx1 + 1):
+                    buckets[cy * self.nx + cx].append(i)
+
+        # Compressed cell -> segment index table
+        self.cell_start = np.zeros(self.nx * self.ny + 1, dtype=int)
+        self.cell_start[1:] = np.cumsum([len(b) for b in buckets])
+        self.cell_items = np.array([i for b in buckets for i in b], dtype=int)
+
+    def get_arrays(self):
+        # The built index, passing it back as index skips the build.
+        return self.cell_start, self.cell_items
+
+    def cell_x(self, x):
+        return min(self.nx - 1, max(0, int((x - self.min_x) / self.cell_w)))
+
+    def cell_y(self, y):
+        return min(self.ny - 1, max(0, int((y - self.min_y) / self.cell_h)))
+
+    def get_cell(self, cell):
+        return self.cell_items[self.cell_start.item(cell):self.cell_start.item(cell + 1)]
+
+    def traverse(self, ox, oy, dx, dy, max_t):
+        # Yields (cell, t_exit) for every non empty cell along the ray, nearest first (DDA).
+        t0 = 0.0
+        t1 = max_t
+        for o, d, lo, hi in ((ox, dx, self.min_x, self.max_x), (oy, dy, self.min_y, self.max_y)):
+            if d == 0:
+                if o < lo or o > hi:
+                    return
+                continue
+            ta = (lo - o) / d
+            tb = (hi - o) / d
+            if ta > tb:
+                ta, tb = tb, ta
+            t0 = max(t0, ta)
+            t1 = min(t1, tb)
+        if t0 > t1:
+            return
+
+        cx = self.cell_x(ox + dx * t0)
+        cy = self.cell_y(oy + dy * t0)
+        if dx > 0:
+            step_x, t_max_x, t_delta_x = 1, (self.min_x + (cx + 1) * self.cell_w - ox) / dx, self.cell_w / dx
+        elif dx < 0:
+            step_x, t_max_x, t_delta_x = -1, (self.min_x + cx * self.cell_w - ox) / dx, -self.cell_w / dx
+        else:
+            step_x, t_max_x, t_delta_x = 0, float("inf"), 0
+        if dy > 0:
+            step_y, t_max_y, t_delta_y = 1, (self.min_y + (cy + 1) * self.cell_h - oy) / dy, self.cell_h / dy
+        elif dy < 0:
+            step_y, t_max_y, t_delta_y = -1, (self.min_y + cy * self.cell_h - oy) / dy, -self.cell_h / dy
+        else:
+            step_y, t_max_y, t_delta_y = 0, float("inf"), 0
+
+        # The index may be mapped from a file shared with other processes, read in place.
+        start = self.cell_start.item
+        while True:
+            cell = cy * self.nx + cx
+            t_exit = min(t_max_x, t_max_y, t1)
+            if start(cell) != start(cell + 1):
+                yield cell, t_exit
+            if t_exit >= t1:
+                return
+            if t_max_x < t_max_y:
+                cx += step_x
+                if cx < 0 or cx >= self.nx:
+                    return
+                t_max_x += t_delta_x
+            else:
+                cy += step_y
+                if cy < 0 or cy >= self.ny:
+                    return
+                t_max_y += t_delta_y
@@ -0,0 +1,34 @@
+import math
+
+# Collision rays cast for every tick, relative to the heading. The stages probe these directions.
+COLLISION_FAN = (0.0, math.radians(20), -math.radians(20))
+
+
+class SensorFrame(object):
+    # All rays of one tick from the player position. The fan and the aim ray are cast together up front,
+    # any other ray is cast on first request and remembered until the next tick.
+    def __init__(self, raycaster, player):
+        self.raycaster = raycaster
+        self.origin = (player.x, player.y)
+        self.memo = {}
+        self.fetch([player.theta + offset for offset in COLLISION_FAN], None, True)
+        self.fetch([player.aim], None, False)
+
+    def fetch(self, thetas, leave_out, collision_mode):
+        origins = [self.origin] * len(thetas)
+        if collision_mode:
+            points, _, indices = self.raycaster.free_distance(origins, thetas, leave_out)
+        else:
+            points, _, indices = self.raycaster.cast_many(origins, thetas, leave_out)
+        for theta, (x, y), index in zip(thetas, points.tolist(), indices.tolist()):
+            self.memo[(theta, leave_out, collision_mode)] = (x, y, index)
+
+    def cast(self, theta, leave_out_player=None, collision_mode=False):
+        # Same as Raycaster.cast from the player position.
+        key = (theta, leave_out_player, collision_mode)
+        if key not in self.memo:
+            self.fetch([theta], leave_out_player, collision_mode)
+        x, y, index = self.memo[key]
+        if index < 0:
+            return None, None, None
+        return x, y, self.raycaster.get_hit_object(index, collision_mode)
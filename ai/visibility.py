@@ -0,0 +1,139 @@
+from __future__ import division
+import math
+import numpy as np
+from geometry import split_segments
+
+TWO_PI = 2 * math.pi
+
+
+class SweepSegment(object):
+    __slots__ = ("x0", "y0", "ex", "ey", "num", "start", "end")
+
+    def __init__(self, x0, y0, x1, y1, ox, oy):
+        self.x0 = x0
+        self.y0 = y0
+        self.ex = x1 - x0
+        self.ey = y1 - y0
+        self.num = (x0 - ox) * self.ey - (y0 - oy) * self.ex
+        self.start = 0.0
+        self.end = 0.0
+
+    def distance(self, c, s):
+        # Distance from the origin to the segment line along direction (c, s).
+        denom = c * self.ey - s * self.ex
+        if denom == 0:
+            return float("inf")
+        return self.num / denom
+
+
+def closer(a, b, start, angle):
+    # Compare both segments in the middle of their common angular range, non crossing segments keep their order there.
+    phi = start + (angle + min(a.end, b.end)) / 2
+    c = math.cos(phi)
+    s = math.sin(phi)
+    return a.distance(c, s) < b.distance(c, s)
+
+
+def insert(active, segment, start, angle):
+    lo = 0
+    hi = len(active)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if closer(active[mid], segment, start, angle):
+            lo = mid + 1
+        else:
+            hi = mid
+    active.insert(lo, segment)
+
+
+def split_crosses(crosses, walls):
+    # Player crosses intersect in their center and may poke into walls, the sweep needs non crossing segments.
+    centers = (crosses[:, 0:2] + crosses[:, 2:4]) / 2
+    halves = np.vstack((np.hstack((crosses[:, 0:2], centers)), np.hstack((centers, crosses[:, 2:4]))))
+    if len(halves) == 0 or len(walls) == 0:
+        return halves
+    return split_segments(halves, walls)
+
+
+def visibility_polygon(raycaster, x, y, theta, fov, leave_out=None):
+    # Angular plane sweep over the vision layer of the raycaster.
+    # Returns the visible area within theta +- fov / 2 as a list of (x, y) points starting at the origin.
+    start = theta - fov / 2
+    max_range = raycaster.get_map_size() * 1.5
+    crosses = raycaster.crosses
+    if leave_out is not None and leave_out in raycaster.player_index:
+        crosses = crosses[raycaster.cross_owners != raycaster.player_index[leave_out]]
+    walls = raycaster.geometry.get_sweep_segments()
+    lines = walls.tolist() + split_crosses(crosses, raycaster.wall_segments).tolist()
+
+    # Sweep events, segments crossing the start ray are active from the beginning.
+    active = []
+    events = []
+    for x0, y0, x1, y1 in lines:
+        a0 = (math.atan2(y0 - y, x0 - x) - start) % TWO_PI
+        a1 = (math.atan2(y1 - y, x1 - x) - start) % TWO_PI
+        lo = min(a0, a1)
+        hi = max(a0, a1)
+        if lo == hi or hi - lo == math.pi:
+            continue
+        segment = SweepSegment(x0, y0, x1, y1, x, y)
+        if hi - lo < math.pi:
+            segment.start = lo
+            segment.end = hi
+            events.append((lo, True, segment))
+            events.append((hi, False, segment))
+        else:
+            segment.end = lo
+            active.append(segment)
+            events.append((lo, False, segment))
+            events.append((hi, True, segment))
+    # At equal angles closings come first, an opening compared against a segment ending right there would
+    # measure both on the shared vertex.
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    # Initial order of the segments crossing the start ray.
+    initial = active
+    active = []
+    for segment in initial:
+        insert(active, segment, start, 0.0)
+
+    points = [(x, y)]
+
+    def point_at(segment, angle):
+        c = math.cos(start + angle)
+        s = math.sin(start + angle)
+        d = max_range if segment is None else min(max_range, segment.distance(c, s))
+        return x + c * d, y + s * d
+
+    i = 0
+    started = False
+    while i < len(events):
+        angle = events[i][0]
+        if angle > fov:
+            break
+        if not started and angle > 0:
+            points.append(point_at(active[0] if active else None, 0.0))
+            started = True
+
+        # Apply all events at this angle at once.
+        before = active[0] if active else None
+        while i < len(events) and events[i][0] == angle:
+            _, opening, segment = events[i]
+            if opening:
+                if segment.start != angle:
+                    segment.start = angle
+                    segment.end = TWO_PI
+                insert(active, segment, start, angle)
+            else:
+                active.remove(segment)
+            i += 1
+        after = active[0] if active else None
+
+        if started and before is not after:
+            points.append(point_at(before, angle))
+            points.append(point_at(after, angle))
+
+    if not started:
+        points.append(point_at(active[0] if active else None, 0.0))
+    points.append(point_at(active[0] if active else None, fov))
+    return points
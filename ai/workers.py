@@ -0,0 +1,166 @@
+import atexit
+import signal
+import sys
+import time
+from multiprocessing import Event, Process, Queue, Value
+from socket import error as socket_error
+from ai import AI
+from event_loop import EventLoop
+from geometry import release_geometry
+from log import log as log
+try:
+    from queue import Empty, Full
+except ImportError:
+    from Queue import Empty, Full
+
+# Render snapshots in flight between a worker and the UI, the oldest ones are dropped while the UI is behind.
+CHANNEL_SIZE = 4
+
+# Seconds the workers get to shut down on their own before they are terminated.
+STOP_TIMEOUT = 3.0
+
+
+def report_metrics(ais):
+    for ai in ais:
+        log(ai.report_metrics())
+
+
+def run_ais(name, ids, renderer, host, port, event_loop=False, record_dir=None, ais=None, stopping=None):
+    # Runs until stopping is set, ais holds the current AIs for the caller to report on.
+    if ais is None:
+        # Dump the tick timings of the current AIs on exit.
+        ais = []
+        atexit.register(report_metrics, ais)
+
+    while stopping is None or not stopping.is_set():
+        # A finished session reports its timings before its AIs make room, the last one is reported on exit.
+        report_metrics(ais)
+        del ais[:]
+        try:
+            for i in ids:
+                ais.append(AI(name, i, renderer, host, port, threaded=not event_loop, record_dir=record_dir))
+
+            if event_loop:
+                loop = EventLoop(stopping)
+                for ai in ais:
+                    loop.add(ai)
+                loop.run()
+            for ai in ais:
+                ai.join()
+        except socket_error as serr:
+            for ai in ais:
+                ai.stop()
+            log("Retry in 3s.")
+            if stopping is not None:
+                stopping.wait(3)
+            else:
+                time.sleep(3)
+
+
+class RemoteRenderer(object):
+    # Stands in for the renderer inside a worker and forwards the render snapshots to the UI process. The walls
+    # of a map go once over the maps queue, which never drops, the snapshots only carry their geometry key.
+    def __init__(self, selected, channel, maps):
+        self.selected = selected
+        self.channel = channel
+        self.maps = maps
+        self.sent = set()
+
+    def get_selected_player(self):
+        return self.selected.value
+
+    def publish(self, snapshot):
+        if snapshot.walls is not None:
+            if snapshot.map_key not in self.sent:
+                self.maps.put((snapshot.map_key, snapshot.walls))
+                self.sent.add(snapshot.map_key)
+            snapshot = snapshot._replace(walls=None)
+        try:
+            self.channel.put_nowait(snapshot)
+        except Full:
+            # Make room by dropping the oldest snapshot, the UI shows the newest one.
+            try:
+                self.channel.get_nowait()
+            except Empty:
+                pass
+            try:
+                self.channel.put_nowait(snapshot)
+            except Full:
+                pass
+
+
+def run_worker(name, ids, host, port, selected, channel, maps, record_dir, stopping):
+    # Exit cleanly on terminate() so the timings get dumped. A child process leaves through os._exit
+    # without running atexit hooks, the timings are reported here instead.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    ais = []
+    try:
+        run_ais(name, ids, RemoteRenderer(selected, channel, maps), host, port, event_loop=True, record_dir=record_dir,
+                ais=ais, stopping=stopping)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        report_metrics(ais)
+        release_geometry()
+
+
+class WorkerPool(object):
+    # Shards the AIs over worker processes, each running its own event loop.
+    def __init__(self, renderer, workers, name, ai_count, host, port, record_dir=None):
+        self.renderer = renderer
+        self.selected = Value("i", renderer.get_selected_player())
+        self.channel = Queue(CHANNEL_SIZE)
+        self.maps = Queue()
+        self.walls = {}
+        self.stopping = Event()
+        self.processes = []
+        ids = list(range(1, ai_count + 1))
+        for k in range(min(workers, ai_count)):
+            p = Process(target=run_worker, args=(name, ids[k::workers], host, port, self.selected, self.channel, self.maps,
+                                                   record_dir, self.stopping))
+            p.daemon = True
+            self.processes.append(p)
+
+    def start(self):
+        for p in self.processes:
+            p.start()
+
+    def forward(self):
+        # Keeps the workers informed about the selection and hands their render snapshots to the local renderer.
+        while True:
+            self.selected.value = self.renderer.get_selected_player()
+            try:
+                snapshot = self.channel.get(timeout=0.1)
+            except Empty:
+                continue
+            if snapshot.map_key is not None:
+                walls = self.get_walls(snapshot.map_key)
+                if walls is None:
+                    continue
+                snapshot = snapshot._replace(walls=walls)
+            self.renderer.publish(snapshot)
+
+    def get_walls(self, key):
+        # The walls are queued before the first snapshot of their map, but may arrive a little after it.
+        while key not in self.walls:
+            try:
+                map_key, walls = self.maps.get(timeout=1.0)
+            except Empty:
+                return None
+            self.walls[map_key] = walls
+        return self.walls[key]
+
+    def join(self):
+        for p in self.processes:
+            p.join()
+
+    def stop(self):
+        # Ask the workers to finish their AIs first, terminate the ones that do not.
+        self.stopping.set()
+        deadline = time.time() + STOP_TIMEOUT
+        for p in self.processes:
+            p.join(max(0.0, deadline - time.time()))
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+                p.join()
@@ -0,0 +1,326 @@
+#!/bin/python
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import numpy as np
+from ai.ai import AI, STAGES
+from ai.gamestate import Decoder, Gamestate, PlayerState
+from ai.geometry import GRID_MIN_SEGMENTS, WallGeometry, get_geometry
+from ai.metrics import TickMetrics
+from ai.null_renderer import NullRenderer
+from ai.raycaster_fast import Raycaster
+from ai.segment_grid import SegmentGrid
+from ai.visibility import visibility_polygon
+
+NAME = "The Machine Thread"
+TOLERANCE = 1e-9
+SAMPLES = 1 << 16
+
+# Map sizes in walls and rays per cast_many call measured by --grid.
+GRID_WALLS = (1000, 2000, 3000, 4000, 5000, 6000, 7000, 8000, 10000)
+GRID_RAYS = (1, 4, 16)
+GRID_CALLS = 200
+
+# Maps, players per map and rays per player checked by --vision.
+VISION_MAPS = 200
+VISION_PLAYERS = 4
+VISION_RAYS = 50
+VISION_WALLS = 40
+VISION_FOV = math.radians(120)
+
+
+class CommandSink(object):
+    # Stands in for the server socket and keeps every command the AI sends.
+    def __init__(self):
+        self.commands = []
+
+    def send(self, data, flags=0):
+        self.commands.append(data.rstrip("\n"))
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded gamestates through the AI as fast as possible.")
+    parser.add_argument("corpus", nargs="+",
+                        help="recordings or directories of recordings written by main.py --record")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="replay the corpus N times")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare the commands against FILE")
+    parser.add_argument("--save-baseline", metavar="FILE",
+                        help="store the commands of this run as baseline in FILE")
+    parser.add_argument("--model", action="store_true",
+                        help="compare memory and decode time of the packet dicts and the decoded gamestates")
+    parser.add_argument("--grid", action="store_true",
+                        help="time casts through the segment grid against the broadcast on random maps of growing size")
+    parser.add_argument("--vision", action="store_true",
+                        help="check the visibility polygon against casts on random maps, fails on any mismatch")
+    return parser.parse_args()
+
+
+def find_recordings(paths):
+    recordings = []
+    for path in paths:
+        if os.path.isdir(path):
+            recordings.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".jsonl")))
+        else:
+            recordings.append(path)
+    return recordings
+
+
+def load(path):
+    with open(path) as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def replay(lines, metrics):
+    # A fresh AI per recording, tracked enemies must not leak between games.
+    sink = CommandSink()
+    ai = AI(NAME, 1, NullRenderer(), threaded=False, sock=sink)
+    ai.metrics = ai.writer.metrics = metrics
+    sink.commands = []
+    casts = 0
+    raycaster = None
+    start = time.time()
+    for line in lines:
+        ai.process(line)
+        # A map change replaces the raycaster, count the casts of every one.
+        if ai.raycaster is not raycaster:
+            if raycaster is not None:
+                casts += raycaster.casts
+            raycaster = ai.raycaster
+    elapsed = time.time() - start
+    if raycaster is not None:
+        casts += raycaster.casts
+    return sink.commands, elapsed, casts
+
+
+def footprint(obj, seen=None):
+    # Bytes held by obj and everything it references, arrays count with their buffer.
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + sys.getsizeof(obj) if obj.base is None else sys.getsizeof(obj) + footprint(obj.base, seen)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(footprint(k, seen) + footprint(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(footprint(v, seen) for v in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(footprint(getattr(obj, field), seen) for field in obj.__slots__)
+    return size
+
+
+def measure_model(corpus):
+    # Average footprint of a tick as packet dict and as Gamestate, and the time to parse or decode a line.
+    lines = [line for _, lines in corpus for line in lines if '"gamestate"' in line]
+    if not lines:
+        print("no gamestates in the corpus")
+        return
+    packets = [json.loads(line)["gamestate"] for line in lines]
+    states = [Gamestate(packet) for packet in packets]
+    dict_bytes = sum(footprint(packet) for packet in packets) / float(len(packets))
+    state_bytes = sum(footprint(state) for state in states) / float(len(states))
+
+    start = time.time()
+    for line in lines:
+        json.loads(line)
+    parse = (time.time() - start) / len(lines)
+    decoder = Decoder()
+    start = time.time()
+    for line in lines:
+        decoder.decode(line)
+    decode = (time.time() - start) / len(lines)
+
+    print("gamestate as dicts: " + str(int(dict_bytes)) + " bytes, as Gamestate: " + str(int(state_bytes)) + " bytes")
+    print("json.loads " + str(round(parse * 1e3, 3)) + "ms, Decoder " + str(round(decode * 1e3, 3)) + "ms")
+
+
+def random_walls(count, seed=1):
+    # A square border and count axis aligned walls of up to 8 units, as dense as the default map.
+    r = random.Random(seed)
+    h = 25.0 * math.sqrt(count / 40.0)
+    walls = [[-h, -h, h, -h], [h, -h, h, h], [h, h, -h, h], [-h, h, -h, -h]]
+    for _ in range(count):
+        x = r.uniform(-h + 2, h - 2)
+        y = r.uniform(-h + 2, h - 2)
+        if r.random() < 0.5:
+            walls.append([x, y, min(h - 1, x + r.uniform(1, 8)), y])
+        else:
+            walls.append([x, y, x, min(h - 1, y + r.uniform(1, 8))])
+    return np.array(walls), h
+
+
+def time_casts(geometry, grid, rays, h):
+    # Best of three passes in microseconds per ray, the rays of a call start at the same point.
+    geometry.wall_grid = grid
+    raycaster = Raycaster(geometry)
+    raycaster.update([])
+    r = random.Random(2)
+    calls = [([(r.uniform(-h, h), r.uniform(-h, h))] * rays, [r.uniform(-math.pi, math.pi) for _ in range(rays)])
+             for _ in range(GRID_CALLS)]
+    best = None
+    for _ in range(3):
+        start = time.time()
+        for origins, thetas in calls:
+            raycaster.cast_many(origins, thetas)
+        elapsed = (time.time() - start) / (GRID_CALLS * rays) * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_grid():
+    # The segment count from which walking the grid beats the broadcast, compare with GRID_MIN_SEGMENTS.
+    print("GRID_MIN_SEGMENTS " + str(GRID_MIN_SEGMENTS))
+    for rays in GRID_RAYS:
+        crossover = None
+        for count in GRID_WALLS:
+            walls, h = random_walls(count)
+            geometry = WallGeometry(walls)
+            segments = len(geometry.wall_segments)
+            broadcast = time_casts(geometry, None, rays, h)
+            grid = time_casts(geometry, SegmentGrid(geometry.wall_segments), rays, h)
+            if grid < broadcast and crossover is None:
+                crossover = segments
+            print(str(rays) + " rays, " + str(segments) + " segments: broadcast " + str(round(broadcast, 1)) +
+                  "us/ray, grid " + str(round(grid, 1)) + "us/ray")
+        print(str(rays) + " rays: grid " + ("faster from " + str(crossover) + " segments" if crossover is not None
+                                            else "never faster"))
+
+
+def random_players(walls, count, h, r):
+    # Players at random spots clear of every wall.
+    players = []
+    while len(players) < count:
+        x = r.uniform(-h + 1, h - 1)
+        y = r.uniform(-h + 1, h - 1)
+        px = walls[:, 2] - walls[:, 0]
+        py = walls[:, 3] - walls[:, 1]
+        t = np.clip(((x - walls[:, 0]) * px + (y - walls[:, 1]) * py) / (px * px + py * py), 0.0, 1.0)
+        if np.hypot(walls[:, 0] + t * px - x, walls[:, 1] + t * py - y).min() <= 1.0:
+            continue
+        players.append(PlayerState({"name": "p" + str(len(players)), "x": x, "y": y,
+                                    "theta": r.uniform(-math.pi, math.pi), "aim": r.uniform(-math.pi, math.pi)}))
+    return players
+
+
+def polygon_distance(polygon, x, y, c, s):
+    # Distance from the origin of the polygon to its boundary along direction (c, s), edges along the ray
+    # are skipped.
+    best = float("inf")
+    for (x0, y0), (x1, y1) in zip(polygon[1:], polygon[2:]):
+        ex = x1 - x0
+        ey = y1 - y0
+        denom = c * ey - s * ex
+        if denom == 0:
+            continue
+        d = ((x0 - x) * ey - (y0 - y) * ex) / denom
+        u = ((x0 - x) * s - (y0 - y) * c) / denom
+        if d > 0 and -1e-9 <= u <= 1 + 1e-9:
+            best = min(best, d)
+    return best
+
+
+def check_vision():
+    # Compares the visibility polygon with vision casts on random maps, returns the rays that differ.
+    r = random.Random(5)
+    mismatches = 0
+    rays = 0
+    for seed in range(VISION_MAPS):
+        walls, h = random_walls(VISION_WALLS, seed)
+        raycaster = Raycaster(get_geometry(walls))
+        players = random_players(walls, VISION_PLAYERS, h, r)
+        raycaster.update(players)
+        for player in players:
+            polygon = visibility_polygon(raycaster, player.x, player.y, player.aim, VISION_FOV, player.name)
+            thetas = [player.aim - VISION_FOV / 2 + VISION_FOV * (k + 0.5) / VISION_RAYS for k in range(VISION_RAYS)]
+            _, distances, _ = raycaster.cast_many([(player.x, player.y)] * VISION_RAYS, thetas, player.name)
+            for theta, distance in zip(thetas, distances.tolist()):
+                expected = min(distance, raycaster.get_map_size() * 1.5)
+                found = polygon_distance(polygon, player.x, player.y, math.cos(theta), math.sin(theta))
+                rays += 1
+                if abs(found - expected) > 1e-6 * max(1.0, expected):
+                    mismatches += 1
+    print("vision: " + str(mismatches) + " of " + str(rays) + " rays differ from the casts")
+    return mismatches
+
+
+def same_command(a, b):
+    a = json.loads(a)
+    b = json.loads(b)
+    if sorted(a) != sorted(b):
+        return False
+    for key in a:
+        if abs(a[key] - b[key]) > TOLERANCE * max(1.0, abs(a[key]), abs(b[key])):
+            return False
+    return True
+
+
+def compare(commands, baseline):
+    mismatches = 0
+    for path in sorted(commands):
+        expected = baseline.get(path)
+        if expected is None or len(expected) != len(commands[path]):
+            print(path + ": baseline has a different number of commands")
+            mismatches += 1
+            continue
+        for tick, (a, b) in enumerate(zip(commands[path], expected)):
+            if not same_command(a, b):
+                print(path + ": tick " + str(tick) + " sent " + a + " instead of " + b)
+                mismatches += 1
+                break
+    return mismatches
+
+
+def main(args):
+    recordings = find_recordings(args.corpus)
+    # Recordings of AIs that never got a line are left out, they have no commands to compare.
+    corpus = [(path, lines) for path, lines in ((path, load(path)) for path in recordings) if lines]
+    if args.model:
+        measure_model(corpus)
+    if args.grid:
+        measure_grid()
+    if args.vision and check_vision():
+        return 1
+    ticks = 0
+    casts = 0
+    elapsed = 0.0
+    commands = {}
+    metrics = TickMetrics(STAGES, SAMPLES)
+    for _ in range(args.repeat):
+        for path, lines in corpus:
+            sent, seconds, count = replay(lines, metrics)
+            ticks += len(sent)
+            casts += count
+            elapsed += seconds
+            commands[os.path.basename(path)] = sent
+
+    print(str(len(corpus)) + " recordings, " + str(ticks) + " ticks in " + str(round(elapsed, 3)) + "s")
+    if elapsed > 0:
+        print(str(round(ticks / elapsed, 1)) + " ticks/s, " + str(round(casts / elapsed, 1)) + " casts/s")
+    print(metrics.report())
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(commands, f)
+    if args.baseline:
+        with open(args.baseline) as f:
+            mismatches = compare(commands, json.load(f))
+        print("Commands " + ("match the baseline" if mismatches == 0 else "differ from the baseline"))
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
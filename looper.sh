@@ -4,5 +4,5 @@ echo "kill $$" > kill-ai.sh
 
 while true
 do
-  python main.py 4 localhost 2016
+  python main.py 4 localhost 2016 "$@"
 done
@@ -1,39 +1,83 @@
 #!/bin/python
 
+import argparse
+import signal
 import sys
-from ai.ai import AI
-from renderer.ui import ui as ui
-from ai.log import log as log
+from ai.workers import run_ais, WorkerPool
+from ai.geometry import share_geometry, release_geometry
+from ai.geometry_store import default_directory
+from ai.null_renderer import NullRenderer
 from threading import Thread
-import time
-import errno
-from socket import error as socket_error
-from renderer.renderer import Renderer
-
-renderer = Renderer()
-
-def main():
-    amount_of_ais = int(sys.argv[1])
-    host = sys.argv[2]
-    port = int(sys.argv[3])
-    while True:
-        ais = []
+
+NAME = "The Machine Thread"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run AIs against an Into Darkness server.")
+    parser.add_argument("ai_count", type=int)
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--event-loop", action="store_true",
+                        help="drive all AIs from one select() loop instead of two threads per AI")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="spread the AIs over N worker processes")
+    parser.add_argument("--record", metavar="DIR",
+                        help="record the raw server lines of every AI into DIR for benchmark.py")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window, pygame and the renderer are never imported")
+    parser.add_argument("--share-geometry", metavar="DIR", nargs="?", const=default_directory(),
+                        help="publish the wall geometry of a map once into DIR (default " + default_directory() +
+                             ") and map it into every other process that plays the map")
+    return parser.parse_args()
+
+
+def main(args, renderer):
+    run_ais(NAME, range(1, args.ai_count + 1), renderer, args.host, args.port, args.event_loop, args.record)
+
+
+def headless(args):
+    # No UI to block on, the AIs or the worker pool keep the main thread.
+    renderer = NullRenderer()
+    if args.workers > 0:
+        # Leave through the finally below on kill as well, the workers get stopped and report their timings.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        pool = WorkerPool(renderer, args.workers, NAME, args.ai_count, args.host, args.port, args.record)
+        pool.start()
         try:
-            for i in range(amount_of_ais):
-                ais.append(AI("The Machine Thread", i+1, renderer, host, port))
-
-            for ai in ais:
-                ai.join()
-        except socket_error as serr:
-            for ai in ais:
-                ai.stop()
-            log("Retry in 3s.")
-            time.sleep(3)
-
-if len(sys.argv) == 4:
-    t = Thread(target=main)
+            pool.join()
+        finally:
+            pool.stop()
+    else:
+        main(args, renderer)
+
+
+def windowed(args):
+    # Only import pygame when there is something to show.
+    from renderer.ui import ui as ui
+    from renderer.renderer import Renderer
+    renderer = Renderer()
+    if args.workers > 0:
+        # Fork the workers before the UI initializes pygame.
+        pool = WorkerPool(renderer, args.workers, NAME, args.ai_count, args.host, args.port, args.record)
+        pool.start()
+        t = Thread(target=pool.forward)
+    else:
+        t = Thread(target=main, args=(args, renderer))
     t.setDaemon(True)
     t.start()
     ui(renderer)
-else:
-    print("Usage: python main.py <ai_count> <host> <port>")
+    if args.workers > 0:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.share_geometry:
+        share_geometry(args.share_geometry)
+    try:
+        if args.headless:
+            headless(args)
+        else:
+            windowed(args)
+    finally:
+        release_geometry()
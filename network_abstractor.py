@@ -1,11 +1,174 @@
+import argparse
+import errno
+import select
 import socket
 import json
 import sys
-from threading import Thread
+import time
+import traceback
+from collections import deque
+from threading import Thread, Lock
+from ai.metrics import RollingHistogram, RateCounter
+
+RECV_SIZE = 65536
+IDLE_TIMEOUT = 10.0
+# Bytes a connection may have waiting for its socket before it is closed, a few seconds of gamestates.
+MAX_QUEUED = 1 << 20
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+# Poll masks, epoll uses the same values.
+READ = select.POLLIN | select.POLLERR | select.POLLHUP
+WRITE = select.POLLOUT
+
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
+
+class LinkStats(object):
+    # Relay figures for one ai name. "up" is ai -> game server, "down" is game server -> ai.
+    # Written by the relay threads and read by the stats threads, all access goes through the lock.
+    def __init__(self):
+        self.latency = {"up": RollingHistogram(), "down": RollingHistogram()}
+        self.bytes = {"up": RateCounter(), "down": RateCounter()}
+        self.lines = {"up": RateCounter(), "down": RateCounter()}
+        self.queue_depth = RollingHistogram()
+        self.reconnects = 0
+        self.overflows = 0
+        self.lock = Lock()
+
+    def forwarded(self, direction, data, lines, received):
+        with self.lock:
+            self.latency[direction].record(time.time() - received)
+            self.bytes[direction].add(len(data))
+            self.lines[direction].add(lines)
+
+    def reconnected(self):
+        with self.lock:
+            self.reconnects += 1
+
+    def overflowed(self):
+        with self.lock:
+            self.overflows += 1
+
+    def queued(self, depth):
+        with self.lock:
+            self.queue_depth.record(depth)
+
+    def report(self, name):
+        with self.lock:
+            out = [name + ": reconnects=" + str(self.reconnects) + " overflows=" + str(self.overflows) +
+                   " queue_bytes " + self.queue_depth.summary(scale=1, unit="")]
+            for direction in ("up", "down"):
+                out.append("  %s %.1f lines/s %.1f bytes/s latency %s" % (
+                    direction, self.lines[direction].rate(), self.bytes[direction].rate(),
+                    self.latency[direction].summary()))
+        return out
+
+
+class RelayStats(object):
+    def __init__(self):
+        self.links = {}
+        self.lock = Lock()
+
+    def get(self, name):
+        with self.lock:
+            link = self.links.get(name)
+            if link is None:
+                link = LinkStats()
+                self.links[name] = link
+            return link
+
+    def report(self):
+        with self.lock:
+            links = sorted(self.links.items())
+        out = []
+        for name, link in links:
+            out.extend(link.report(name))
+        return "\n".join(out) + "\n"
+
+
+class StatsServer(object):
+    # Plaintext stats on a local port and/or dumped to stdout every interval seconds.
+    def __init__(self, stats, port=0, interval=0, host="127.0.0.1"):
+        self.stats = stats
+        self.interval = interval
+        if port > 0:
+            self.server = socket.socket()
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind((host, port))
+            self.server.listen(5)
+            print("Serving relay stats on: " + host + ":" + str(port))
+            t = Thread(target=self.serve)
+            t.setDaemon(True)
+            t.start()
+        if interval > 0:
+            t = Thread(target=self.dump)
+            t.setDaemon(True)
+            t.start()
+
+    def serve(self):
+        while True:
+            (sock, addr) = self.server.accept()
+            try:
+                sock.sendall(self.stats.report().encode("utf-8"))
+            except socket.error:
+                pass
+            sock.close()
+
+    def dump(self):
+        while True:
+            time.sleep(self.interval)
+            print(self.stats.report())
+
+
+class UpstreamPool(object):
+    # Game server connections by ai name. A connection outlives its ai for idle_timeout seconds,
+    # so an ai reconnecting under the same name reattaches to it without a new handshake.
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.upstreams = {}
+        self.detached = {}
+        self.lock = Lock()
+
+    def add(self, name, upstream):
+        with self.lock:
+            self.upstreams[name] = upstream
+            self.detached.pop(name, None)
+
+    def attach(self, name):
+        with self.lock:
+            self.detached.pop(name, None)
+            return self.upstreams.get(name)
+
+    def get(self, name):
+        return self.upstreams.get(name)
+
+    def detach(self, name):
+        with self.lock:
+            if name in self.upstreams:
+                self.detached[name] = time.time()
+
+    def remove(self, name, upstream):
+        # Returns False if the upstream was reaped or replaced already.
+        with self.lock:
+            if self.upstreams.get(name) is not upstream:
+                return False
+            del self.upstreams[name]
+            self.detached.pop(name, None)
+            return True
+
+    def expired(self):
+        # Removes and returns the upstreams nobody reattached to in time.
+        now = time.time()
+        with self.lock:
+            names = [name for name, since in self.detached.items() if now - since > self.idle_timeout]
+            return [(name, self.upstreams.pop(name)) for name in names if self.detached.pop(name, None) is not None]
 
 
 class NetworkAbstractorServer(object):
-    def __init__(self, game_host, game_port, serv_host="127.0.0.1", serv_port=23232):
+    def __init__(self, game_host, game_port, serv_host="127.0.0.1", serv_port=23232, idle_timeout=IDLE_TIMEOUT):
         self.server = socket.socket()
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((serv_host, serv_port))
@@ -17,12 +180,17 @@ class NetworkAbstractorServer(object):
         
         self.running = True
         self.connections = []
-        self.abstract_connections = {}
+        self.abstract_connections = UpstreamPool(idle_timeout)
         self.matching = {}
+        self.stats = RelayStats()
         
         t = Thread(target=self.accept)
         t.setDaemon(True)
         t.start()
+
+        t = Thread(target=self.reap)
+        t.setDaemon(True)
+        t.start()
         
     def accept(self):
         while self.running:
@@ -39,27 +207,35 @@ class NetworkAbstractorServer(object):
         while self.running:
             try:
                 line = sf.readline().rstrip('\n')
+                received = time.time()
                 event = {"packet": json.loads(line), "sock": sock}
                 if "name" in event["packet"]:
                     name = event["packet"]["name"]
+                    stats = self.stats.get(name)
                     self.matching[name] = sock
                     print("Attached connection to: " + name)
-                    if not name in self.abstract_connections:
+                    if self.abstract_connections.attach(name) is None:
                         s = socket.socket()
                         s.connect((self.game_host, self.game_port))
                         self.connections.append(s)
                         s.send(json.dumps({"name": name}) + "\n")
-                        self.abstract_connections[name] = s
+                        self.abstract_connections.add(name, s)
                         
                         t = Thread(target=self.connection_inverse, args=(s, name))
                         t.setDaemon(True)
                         t.start()
+                    else:
+                        print("Resumed inverse connection for: " + name)
+                        stats.reconnected()
                 elif name is not None:
-                    self.abstract_connections[name].send(line + "\n")
+                    self.abstract_connections.get(name).send(line + "\n")
+                    stats.forwarded("up", line, 1, received)
             except:
                 break
-        if name is not None:
+        # Keep the game connection around for a reconnect, unless a newer connection took over already.
+        if name is not None and self.matching.get(name) is sock:
             del self.matching[name]
+            self.abstract_connections.detach(name)
         try:
             sock.close()
         except:
@@ -74,39 +250,377 @@ class NetworkAbstractorServer(object):
     def connection_inverse(self, sock, name):
         print("Started inverse connection for: " + name)
         sf = sock.makefile()
+        stats = self.stats.get(name)
         while self.running:
             try:
                 line = sf.readline().rstrip('\n')                    
-                if name in self.matching:
-                    self.matching[name].send(line + "\n")
-                    
+                received = time.time()
                 if line == "":
                     break
             except:
                 print("Unexpected error:", sys.exc_info()[0])
                 break
-        del self.abstract_connections[name]
+
+            # A vanished ai is no reason to drop the game connection.
+            target = self.matching.get(name)
+            if target is not None:
+                try:
+                    target.send(line + "\n")
+                    stats.forwarded("down", line, 1, received)
+                except:
+                    pass
+        current = self.abstract_connections.remove(name, sock)
         try:
             sock.close()
         except:
             print("Cannot close socket.", sys.exc_info()[0])
         
         print("Terminated inverse connection for: " + name)
-        if name in self.matching:
+        if current and name in self.matching:
             self.matching[name].close()
         self.connections.remove(sock)
         
+    def reap(self):
+        while self.running:
+            time.sleep(1.0)
+            for name, sock in self.abstract_connections.expired():
+                print("Reaping idle inverse connection for: " + name)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except:
+                    pass
+
     def quit(self):
         self.running = False
         self.server.close()
         for conn in self.connections:
             conn.close()
             
-if len(sys.argv) == 3:
-    NetworkAbstractorServer(sys.argv[1], int(sys.argv[2]))
+class Poller(object):
+    # epoll where available, poll elsewhere. Unlike select() neither is limited to fds below 1024.
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.scale = 1.0
+        else:
+            self.poller = select.poll()
+            self.scale = 1000.0
+
+    def register(self, fd, mask):
+        self.poller.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self.poller.modify(fd, mask)
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except (KeyError, IOError, OSError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        try:
+            return self.poller.poll(timeout * self.scale)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self.poller, "close"):
+            self.poller.close()
+
+
+class Connection(object):
+    # Non blocking socket with a write queue that survives partial writes. The queue holds up to max_queued
+    # bytes, a peer that reads slower than the relay receives is closed instead of growing it further.
+    def __init__(self, sock, name=None, upstream=False, max_queued=MAX_QUEUED):
+        sock.setblocking(0)
+        self.sock = sock
+        self.name = name
+        self.upstream = upstream
+        self.pending = []
+        self.queue = deque()
+        self.queued = 0
+        self.max_queued = max_queued
+        self.closed = False
+        # Whether the poller waits for this socket to become writable.
+        self.writing = False
+        self.stats = None
+
+        # Upstreams remember if their last chunk ended a line, ais attached mid line skip to the next one.
+        self.line_start = True
+        self.resync = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def write(self, data, received=None):
+        # Chunks carry the time they entered the relay. False if the queue is over its bound, the caller
+        # drops the connection.
+        self.queue.append([data, received if received is not None else time.time(), data.count(b"\n")])
+        self.queued += len(data)
+        if self.stats is not None:
+            self.stats.queued(self.queued)
+        return self.queued <= self.max_queued
+
+    def wants_write(self):
+        return len(self.queue) > 0
+
+    def flush(self):
+        while self.queue:
+            chunk = self.queue[0]
+            data = chunk[0]
+            try:
+                sent = self.sock.send(data)
+            except socket.error as e:
+                if e.errno in WOULD_BLOCK:
+                    return
+                raise
+            self.queued -= sent
+            if sent < len(data):
+                chunk[0] = data[sent:]
+                return
+            self.queue.popleft()
+            if self.stats is not None:
+                self.stats.forwarded("up" if self.upstream else "down", data, chunk[2], chunk[1])
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except:
+            print("Cannot close socket.", sys.exc_info()[0])
+
+
+class EventedNetworkAbstractorServer(object):
+    # Same relay as NetworkAbstractorServer but from a single poll loop, every socket is registered once.
+    # Only the handshake is decoded, afterwards raw bytes are forwarded in both directions.
+    def __init__(self, game_host, game_port, serv_host="127.0.0.1", serv_port=23232, idle_timeout=IDLE_TIMEOUT,
+                 max_queued=MAX_QUEUED):
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((serv_host, serv_port))
+        self.server.listen(128)
+        self.server.setblocking(0)
+        print("Listening for ais on: " + serv_host + ":" + str(serv_port))
+
+        self.game_host = game_host
+        self.game_port = game_port
+        self.max_queued = max_queued
+        self.poller = Poller()
+        self.poller.register(self.server.fileno(), READ)
+
+        self.running = True
+        self.connections = {}
+        self.abstract_connections = UpstreamPool(idle_timeout)
+        self.matching = {}
+        self.peers = {}
+        self.stats = RelayStats()
+
+        t = Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def run(self):
+        server = self.server.fileno()
+        while self.running:
+            try:
+                events = self.poller.poll(1.0)
+            except (IOError, OSError, ValueError, select.error):
+                if not self.running:
+                    break
+                raise
+            for fd, mask in events:
+                if fd == server:
+                    self.accept()
+                    continue
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+                # Whatever goes wrong with one connection only takes that connection down.
+                try:
+                    if mask & WRITE and not conn.closed:
+                        conn.flush()
+                        self.watch(conn)
+                    if mask & READ and not conn.closed:
+                        self.read(conn)
+                except socket.error as e:
+                    print("Dropping " + (conn.name or "unknown") + ": " + str(e))
+                    self.drop(conn)
+                except Exception:
+                    print("Dropping " + (conn.name or "unknown") + " after an error:\n" + traceback.format_exc())
+                    self.drop(conn)
+            for name, upstream in self.abstract_connections.expired():
+                print("Reaping idle inverse connection for: " + name)
+                self.drop(upstream)
+
+    def accept(self):
+        try:
+            (sock, addr) = self.server.accept()
+        except socket.error:
+            return
+        conn = Connection(sock, max_queued=self.max_queued)
+        self.connections[conn.fileno()] = conn
+        self.poller.register(conn.fileno(), READ)
+        print("Opened connection")
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.errno in WOULD_BLOCK:
+                return
+            data = b""
+        if not data:
+            self.drop(conn)
+            return
+        received = time.time()
+
+        peer = self.peers.get(conn)
+        if conn.upstream:
+            line_start = conn.line_start
+            conn.line_start = data.endswith(b"\n")
+            if peer is not None and peer.resync:
+                if not line_start:
+                    data = data[data.find(b"\n") + 1:] if b"\n" in data else b""
+                peer.resync = not line_start and not data
+        if peer is not None:
+            if data:
+                self.forward(peer, data, received)
+        elif conn.name is None:
+            self.handshake(conn, data)
+
+    def forward(self, conn, data, received=None):
+        if not conn.write(data, received):
+            print("Write queue of " + (conn.name or "unknown") + " exceeds " + str(conn.max_queued) + " bytes, closing")
+            if conn.stats is not None:
+                conn.stats.overflowed()
+            self.drop(conn)
+            return
+        self.watch(conn)
+
+    def watch(self, conn):
+        # Ask for writability only while something waits in the queue.
+        if conn.closed or conn.wants_write() == conn.writing:
+            return
+        conn.writing = conn.wants_write()
+        self.poller.modify(conn.fileno(), READ | WRITE if conn.writing else READ)
+
+    def handshake(self, conn, data):
+        # Buffer until the name line is complete, the rest goes to the game server untouched.
+        conn.pending.append(data)
+        if b"\n" not in data:
+            return
+        line, rest = b"".join(conn.pending).split(b"\n", 1)
+        conn.pending = []
+        try:
+            packet = json.loads(line.decode("utf-8"))
+            name = packet["name"]
+        except (ValueError, KeyError, TypeError):
+            self.drop(conn)
+            return
+        if not isinstance(name, STRING_TYPES):
+            self.drop(conn)
+            return
+
+        conn.name = name
+        conn.stats = self.stats.get(name)
+        self.matching[name] = conn
+        print("Attached connection to: " + name)
+        upstream = self.abstract_connections.attach(name)
+        if upstream is None:
+            upstream = self.connect(name)
+        else:
+            print("Resumed inverse connection for: " + name)
+            conn.stats.reconnected()
+            conn.resync = True
+            previous = self.peers.get(upstream)
+            if previous is not None:
+                # A newer connection took over, the old one is stale.
+                self.peers.pop(previous, None)
+                self.drop(previous)
+        self.peers[conn] = upstream
+        self.peers[upstream] = conn
+        if rest:
+            self.forward(upstream, rest)
+
+    def connect(self, name):
+        s = socket.socket()
+        s.setblocking(0)
+        try:
+            s.connect_ex((self.game_host, self.game_port))
+        except socket.error:
+            # E.g. the game host does not resolve, the ai is dropped by the caller.
+            s.close()
+            raise
+        upstream = Connection(s, name, upstream=True, max_queued=self.max_queued)
+        upstream.stats = self.stats.get(name)
+        upstream.write((json.dumps({"name": name}) + "\n").encode("utf-8"))
+        self.connections[upstream.fileno()] = upstream
+        self.poller.register(upstream.fileno(), READ)
+        self.watch(upstream)
+        self.abstract_connections.add(name, upstream)
+        print("Started inverse connection for: " + name)
+        return upstream
+
+    def drop(self, conn):
+        if conn.closed:
+            return
+        self.connections.pop(conn.fileno(), None)
+        self.poller.unregister(conn.fileno())
+        peer = self.peers.pop(conn, None)
+        conn.close()
+        if conn.upstream:
+            # Game server left or the upstream idled out, the ai goes with it.
+            self.abstract_connections.remove(conn.name, conn)
+            print("Terminated inverse connection for: " + conn.name)
+            if peer is not None:
+                self.peers.pop(peer, None)
+                self.drop(peer)
+        else:
+            # Ai left, keep the game connection for a reconnect under the same name.
+            if peer is not None and self.peers.get(peer) is conn:
+                self.peers.pop(peer, None)
+                self.abstract_connections.detach(conn.name)
+            if conn.name is not None and self.matching.get(conn.name) is conn:
+                del self.matching[conn.name]
+            print("Terminated connection for: " + (conn.name or "unknown"))
+
+    def quit(self):
+        self.running = False
+        self.server.close()
+        for conn in list(self.connections.values()):
+            conn.close()
+        self.poller.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Relay AI connections to an Into Darkness server.")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--evented", action="store_true",
+                        help="relay all connections from one select() loop instead of two threads per AI")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a game connection waits for its ai to reconnect")
+    parser.add_argument("--max-queued", type=int, default=MAX_QUEUED,
+                        help="close an evented connection once this many bytes wait for it (default %(default)s)")
+    parser.add_argument("--stats-port", type=int, default=0,
+                        help="serve plaintext relay stats on this local port")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="print relay stats every N seconds")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.evented:
+        relay = EventedNetworkAbstractorServer(args.host, args.port, idle_timeout=args.idle_timeout,
+                                               max_queued=args.max_queued)
+    else:
+        relay = NetworkAbstractorServer(args.host, args.port, idle_timeout=args.idle_timeout)
+    StatsServer(relay.stats, args.stats_port, args.stats_interval)
     try:
         input("Press enter to continue")
     except SyntaxError:
         pass
-else:
-    print("Usage: python network_abstractor.py <host> <port>")
\ No newline at end of file
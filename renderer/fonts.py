@@ -0,0 +1,41 @@
+import pygame
+from collections import OrderedDict
+
+MAX_CACHED_LABELS = 512
+PANEL_COLOUR = (45, 45, 45, 200)
+
+fonts = {}
+labels = OrderedDict()
+panels = {}
+
+
+def get_font(size, face="Arial"):
+    # SysFont lookups are slow, load every face and size once.
+    key = (face, size)
+    font = fonts.get(key)
+    if font is None:
+        font = pygame.font.SysFont(face, size)
+        fonts[key] = font
+    return font
+
+
+def render_text(text, size, colour, face="Arial"):
+    # Rendered labels are kept in a bounded LRU.
+    key = (text, size, colour, face)
+    label = labels.pop(key, None)
+    if label is None:
+        label = get_font(size, face).render(text, 1, colour)
+    labels[key] = label
+    if len(labels) > MAX_CACHED_LABELS:
+        labels.popitem(last=False)
+    return label
+
+
+def get_panel(width, height, colour=PANEL_COLOUR):
+    key = (width, height, colour)
+    panel = panels.get(key)
+    if panel is None:
+        panel = pygame.Surface((width, height), pygame.SRCALPHA)  # per-pixel alpha
+        panel.fill(colour)
+        panels[key] = panel
+    return panel
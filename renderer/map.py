@@ -2,11 +2,30 @@ import pygame
 
 
 class Map(object):
+    layer = None
+    layer_key = None
+
     def __init__(self):
         pass
 
     @staticmethod
-    def render(lines, screen, width, height, map_size):
+    def invalidate():
+        Map.layer = None
+        Map.layer_key = None
+
+    @staticmethod
+    def render(lines, screen, width, height, map_size, walls_key=None):
+        # Walls do not move during a match, draw them once per map and screen size.
+        key = (walls_key, width, height, map_size)
+        if walls_key is None or Map.layer is None or Map.layer_key != key:
+            layer = pygame.Surface((width, height), pygame.SRCALPHA)  # per-pixel alpha
+            Map.render_walls(lines, layer, width, height, map_size)
+            Map.layer = layer
+            Map.layer_key = key
+        screen.blit(Map.layer, (0, 0))
+
+    @staticmethod
+    def render_walls(lines, screen, width, height, map_size):
         scale = height / map_size
 
         for line in lines:
@@ -1,5 +1,6 @@
 import math
 from projectile import Projectile
+from fonts import render_text, get_panel
 import pygame
 import random
 
@@ -68,12 +69,10 @@ class Player(object):
 
         tx = int(player["x"] * scale)
         ty = int((player["y"] + 1.1) * scale)
-        myfont = pygame.font.SysFont("Arial", 12)
 
-        label = myfont.render("(" + str(math.floor(player["health"])) + ") " + player["name"], 1, (128, 128, 128))
+        label = render_text("(" + str(math.floor(player["health"])) + ") " + player["name"], 12, (128, 128, 128))
         if player["respawn"] > 0:
-            label = myfont.render("(" + str(player["respawn"]) + ") " + player["name"], 1, (128, 128, 128))
-        s = pygame.Surface((label.get_width() + 4, label.get_height() + 4), pygame.SRCALPHA)  # per-pixel alpha
-        s.fill((45, 45, 45, 200))
+            label = render_text("(" + str(player["respawn"]) + ") " + player["name"], 12, (128, 128, 128))
+        s = get_panel(label.get_width() + 4, label.get_height() + 4)
         screen.blit(s, (tx + width // 2 - label.get_width() // 2 - 2, -ty + height // 2 - label.get_height() - 2))
         screen.blit(label, (tx + width // 2 - label.get_width() // 2, -ty + height // 2 - label.get_height()))
\ No newline at end of file
@@ -29,6 +29,7 @@ def ui(game):
             if (event.type is pygame.VIDEORESIZE):
                 size = (event.w, event.h)
                 pygame.display.set_mode(size, pygame.RESIZABLE)
+                game.resize(event.w, event.h)
 
             if (event.type is pygame.KEYDOWN and event.key == pygame.K_1):
                 game.select_player(1)
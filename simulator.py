@@ -0,0 +1,454 @@
+#!/bin/python
+
+from __future__ import division
+import argparse
+import json
+import math
+import random
+import select
+import socket
+import time
+import numpy as np
+from ai.geometry import get_geometry
+from ai.metrics import RollingHistogram
+from ai.player import Player, normalize_angles
+from ai.raycaster_fast import Raycaster
+from network_abstractor import Connection, RECV_SIZE, WOULD_BLOCK
+
+FIELDS = ("x", "y", "theta", "aim", "movespeed", "turnspeed", "aimspeed", "health", "respawn", "bloom",
+          "reload_primary", "reload_secondary", "shootstate")
+PLAYER_SIZE = 1.0
+FOV = math.radians(120)
+MAX_HEALTH = 100
+RESPAWN_TICKS = 90
+SPAWN_CLEARANCE = 1.5
+BLOOM_MIN = 0.02
+BLOOM_MOVE = 0.1
+BLOOM_TURN = 0.05
+
+# Per projectile type, index 1 is the primary weapon and 2 the splash weapon.
+PROJECTILE_SPEED = np.array([0.0, 1.5, 0.75])
+PROJECTILE_DAMAGE = np.array([0.0, 10.0, 40.0])
+PROJECTILE_SPLASH = np.array([0.0, 0.5, 3.0])
+RELOAD_TICKS = (0, 6, 30)
+PROJECTILE_TTL = 100
+EXPLOSION_TICKS = 5
+
+LOBBY_INTERVAL = 0.1
+LOCKSTEP_TIMEOUT = 1.0
+
+
+class Client(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.name = None
+        self.index = -1
+        self.command = None
+        self.sent = 0.0
+        self.waiting = False
+        self.ticks = 0
+        self.missed = 0
+        self.latency = RollingHistogram()
+
+
+def random_walls(count, size, rng):
+    # Border plus axis aligned walls of random length.
+    h = size / 2
+    corners = [(-h, -h), (h, -h), (h, h), (-h, h)]
+    walls = [[{"x": a[0], "y": a[1]}, {"x": b[0], "y": b[1]}] for a, b in zip(corners, corners[1:] + corners[:1])]
+    for _ in range(count):
+        x = rng.uniform(-h + 2, h - 2)
+        y = rng.uniform(-h + 2, h - 2)
+        length = rng.uniform(2, size / 6)
+        if rng.random() < 0.5:
+            walls.append([{"x": x, "y": y}, {"x": min(h - 1, x + length), "y": y}])
+        else:
+            walls.append([{"x": x, "y": y}, {"x": x, "y": min(h - 1, y + length)}])
+    return walls
+
+
+class Simulator(object):
+    # Headless game server. All players and projectiles live in numpy arrays and advance together every tick.
+    def __init__(self, walls, host="127.0.0.1", port=2016, tps=30.0, ticks=3000, lobby=5.0, seed=1):
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(128)
+        self.server.setblocking(0)
+        print("Simulating on: " + host + ":" + str(port))
+
+        self.walls = walls
+        self.walls_json = json.dumps(walls)
+        self.raycaster = Raycaster(get_geometry(walls))
+        self.map_size = self.raycaster.get_map_size()
+        self.tps = tps
+        self.ticks = ticks
+        self.lobby = lobby
+        self.rng = random.Random(seed)
+        self.random = np.random.RandomState(seed)
+
+        self.clients = {}
+        self.names = []
+        self.ranking = {}
+        self.players = dict((field, np.zeros(0)) for field in FIELDS)
+        self.projectiles = dict((field, np.zeros(0)) for field in ("x", "y", "theta", "type", "owner", "dead", "ttl"))
+        self.in_game = False
+
+    def run(self):
+        # Lobby in real time, then the game at the configured tick rate (0 waits for every client, lockstep).
+        end = time.time() + self.lobby
+        while time.time() < end:
+            self.broadcast(json.dumps({"lobby": {"timeout": int(math.ceil(end - time.time()))}}) + "\n")
+            self.wait(time.time() + LOBBY_INTERVAL, lockstep=False)
+
+        self.in_game = True
+        for client in self.clients.values():
+            if client.name is not None:
+                self.spawn(client)
+        start = time.time()
+        for tick in range(self.ticks):
+            tick_start = time.time()
+            self.apply_commands()
+            self.step()
+            self.send_gamestates(self.ticks - tick)
+            if self.tps > 0:
+                self.wait(start + (tick + 1) / self.tps, lockstep=False)
+            else:
+                self.wait(tick_start + LOCKSTEP_TIMEOUT, lockstep=True)
+        elapsed = time.time() - start
+        print(self.report(elapsed))
+        self.quit()
+
+    def broadcast(self, line):
+        for client in self.clients.values():
+            if client.name is not None:
+                client.conn.write(line.encode("utf-8"))
+
+    def wait(self, deadline, lockstep):
+        # Serves the sockets until the deadline, in lockstep mode until every client answered.
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return
+            if lockstep and not any(c.waiting for c in self.clients.values()):
+                return
+            writers = [c.conn for c in self.clients.values() if c.conn.wants_write()]
+            readers = [self.server] + [c.conn for c in self.clients.values()]
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+            for conn in readable:
+                if conn is self.server:
+                    self.accept()
+                elif not conn.closed:
+                    self.read(self.clients[conn.fileno()])
+            for conn in writable:
+                if conn.closed:
+                    continue
+                try:
+                    conn.flush()
+                except socket.error:
+                    self.drop(self.clients[conn.fileno()])
+
+    def accept(self):
+        try:
+            (sock, addr) = self.server.accept()
+        except socket.error:
+            return
+        conn = Connection(sock)
+        self.clients[conn.fileno()] = Client(conn)
+
+    def read(self, client):
+        try:
+            data = client.conn.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.errno in WOULD_BLOCK:
+                return
+            data = b""
+        if not data:
+            self.drop(client)
+            return
+        received = time.time()
+        client.conn.pending.append(data)
+        if b"\n" not in data:
+            return
+        lines = b"".join(client.conn.pending).split(b"\n")
+        client.conn.pending = [lines[-1]]
+        for line in lines[:-1]:
+            try:
+                packet = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            if client.name is None:
+                self.handshake(client, packet)
+                continue
+            client.command = packet
+            if client.waiting:
+                client.latency.record(received - client.sent)
+                client.waiting = False
+
+    def handshake(self, client, packet):
+        client.name = str(packet.get("name", "unknown"))
+        print("Joined: " + client.name)
+        if self.in_game:
+            self.spawn(client)
+
+    def drop(self, client):
+        # The player stays in the game and idles.
+        self.clients.pop(client.conn.fileno(), None)
+        client.conn.close()
+        if client.index >= 0:
+            self.players["movespeed"][client.index] = 0
+            self.players["turnspeed"][client.index] = 0
+            self.players["aimspeed"][client.index] = 0
+            self.players["shootstate"][client.index] = 0
+        print("Left: " + (client.name or "unknown"))
+
+    def spawn(self, client):
+        client.index = len(self.names)
+        self.names.append(client.name)
+        self.ranking[client.name] = 0
+        for field in FIELDS:
+            self.players[field] = np.append(self.players[field], 0.0)
+        self.respawn(np.array([client.index]))
+
+    def respawn(self, indices):
+        # Random free spots, a spot is free if no wall is closer than SPAWN_CLEARANCE in any of 8 directions.
+        p = self.players
+        h = self.map_size / 2 - SPAWN_CLEARANCE
+        thetas = np.arange(8) * math.pi / 4
+        for i in indices:
+            for _ in range(100):
+                x = self.rng.uniform(-h, h)
+                y = self.rng.uniform(-h, h)
+                _, dist, _ = self.raycaster.cast_many([(x, y)] * 8, thetas, collision_mode=True)
+                if dist.min() > SPAWN_CLEARANCE:
+                    break
+            p["x"][i] = x
+            p["y"][i] = y
+            p["theta"][i] = self.rng.uniform(-math.pi, math.pi)
+            p["aim"][i] = p["theta"][i]
+            p["health"][i] = MAX_HEALTH
+            p["respawn"][i] = 0
+
+    def apply_commands(self):
+        p = self.players
+        for client in self.clients.values():
+            if client.index < 0:
+                continue
+            if client.waiting:
+                client.missed += 1
+            client.ticks += 1
+            command = client.command
+            if command is None:
+                continue
+            try:
+                p["movespeed"][client.index] = max(-1.0, min(1.0, float(command.get("speed", 0))))
+                p["turnspeed"][client.index] = max(-1.0, min(1.0, float(command.get("turn", 0))))
+                p["aimspeed"][client.index] = max(-1.0, min(1.0, float(command.get("aim", 0))))
+                p["shootstate"][client.index] = int(command.get("shoot", 0))
+            except (TypeError, ValueError, AttributeError):
+                pass
+
+    def step(self):
+        if not self.names:
+            return
+        p = self.players
+        dead = p["respawn"] > 0
+        p["respawn"][dead] -= 1
+        revived = np.nonzero(dead & (p["respawn"] == 0))[0]
+        if len(revived):
+            self.respawn(revived)
+        alive = p["respawn"] == 0
+        p["reload_primary"] = np.maximum(p["reload_primary"] - 1, 0)
+        p["reload_secondary"] = np.maximum(p["reload_secondary"] - 1, 0)
+
+        self.move(np.nonzero(alive)[0])
+        p["bloom"] = BLOOM_MIN + BLOOM_MOVE * np.abs(p["movespeed"]) + BLOOM_TURN * np.abs(p["turnspeed"])
+        self.shoot(alive)
+        self.advance_projectiles()
+
+    def move(self, idx):
+        # Walls block but players do not.
+        p = self.players
+        x, y, theta, aim = Player.move_many(self.raycaster, p["x"][idx], p["y"][idx], p["theta"][idx], p["aim"][idx],
+                                            p["movespeed"][idx], p["turnspeed"][idx], p["aimspeed"][idx])
+        p["x"][idx] = x
+        p["y"][idx] = y
+        p["theta"][idx] = theta
+        p["aim"][idx] = aim
+
+    def shoot(self, alive):
+        p = self.players
+        shots = []
+        for kind, reload in ((1, "reload_primary"), (2, "reload_secondary")):
+            fire = alive & (p["shootstate"] == kind) & (p[reload] <= 0)
+            p[reload][fire] = RELOAD_TICKS[kind]
+            shooters = np.nonzero(fire)[0]
+            if len(shooters):
+                spread = self.random.uniform(-1, 1, len(shooters)) * p["bloom"][shooters]
+                shots.append((shooters, p["aim"][shooters] + spread, kind))
+        q = self.projectiles
+        for shooters, theta, kind in shots:
+            n = len(shooters)
+            q["x"] = np.append(q["x"], p["x"][shooters])
+            q["y"] = np.append(q["y"], p["y"][shooters])
+            q["theta"] = np.append(q["theta"], theta)
+            q["type"] = np.append(q["type"], np.full(n, kind))
+            q["owner"] = np.append(q["owner"], shooters)
+            q["dead"] = np.append(q["dead"], np.zeros(n))
+            q["ttl"] = np.append(q["ttl"], np.full(n, PROJECTILE_TTL))
+
+    def advance_projectiles(self):
+        q = self.projectiles
+        exploding = q["dead"] > 0
+        q["dead"][exploding] -= 1
+        q["ttl"] -= 1
+        keep = ~(exploding & (q["dead"] == 0)) & (q["ttl"] > 0)
+        for field in q:
+            q[field] = q[field][keep]
+        flying = np.nonzero(q["dead"] == 0)[0]
+        if len(flying) == 0:
+            return
+
+        x = q["x"][flying]
+        y = q["y"][flying]
+        theta = q["theta"][flying]
+        kind = q["type"][flying].astype(int)
+        step = PROJECTILE_SPEED[kind]
+        c = np.cos(theta)
+        s = np.sin(theta)
+        _, wall, _ = self.raycaster.cast_many(np.column_stack((x, y)), theta)
+
+        # Closest approach of every projectile path to every living player but its owner.
+        p = self.players
+        px = p["x"][None, :] - x[:, None]
+        py = p["y"][None, :] - y[:, None]
+        t = np.clip(px * c[:, None] + py * s[:, None], 0, step[:, None])
+        ex = px - t * c[:, None]
+        ey = py - t * s[:, None]
+        touching = (ex * ex + ey * ey < (PLAYER_SIZE / 2) ** 2) & (p["respawn"][None, :] == 0)
+        touching &= q["owner"][flying][:, None] != np.arange(len(self.names))[None, :]
+        hit = np.where(touching, t, np.inf).min(axis=1)
+
+        travel = np.minimum(np.minimum(wall, hit), step)
+        impact = (wall <= step) | (hit <= step)
+        q["x"][flying] = x + c * travel
+        q["y"][flying] = y + s * travel
+        q["dead"][flying[impact]] = EXPLOSION_TICKS
+        if impact.any():
+            self.explode(flying[impact])
+
+    def explode(self, impacts):
+        q = self.projectiles
+        p = self.players
+        kind = q["type"][impacts].astype(int)
+        dx = p["x"][None, :] - q["x"][impacts][:, None]
+        dy = p["y"][None, :] - q["y"][impacts][:, None]
+        radius = PROJECTILE_SPLASH[kind] + PLAYER_SIZE / 2
+        within = (dx * dx + dy * dy <= (radius * radius)[:, None]) & (p["respawn"][None, :] == 0)
+        if not within.any():
+            return
+        was_alive = p["health"] > 0
+        p["health"] -= (within * PROJECTILE_DAMAGE[kind][:, None]).sum(axis=0)
+        for victim in np.nonzero(was_alive & (p["health"] <= 0))[0]:
+            killer = int(q["owner"][impacts][np.argmax(within[:, victim])])
+            if killer != victim:
+                self.ranking[self.names[killer]] += 1
+            p["health"][victim] = 0
+            p["respawn"][victim] = RESPAWN_TICKS
+
+    def visible(self):
+        # (observer, target) pairs within the field of view and not hidden behind a wall.
+        p = self.players
+        dx = p["x"][None, :] - p["x"][:, None]
+        dy = p["y"][None, :] - p["y"][:, None]
+        angle = np.arctan2(dy, dx)
+        candidates = (np.abs(normalize_angles(angle - p["theta"][:, None])) <= FOV / 2) & (p["respawn"][None, :] == 0)
+        np.fill_diagonal(candidates, False)
+        observers, targets = np.nonzero(candidates)
+        if len(observers) == 0:
+            return observers, targets
+        origins = np.column_stack((p["x"][observers], p["y"][observers]))
+        _, wall, _ = self.raycaster.cast_many(origins, angle[observers, targets])
+        seen = wall >= np.hypot(dx[observers, targets], dy[observers, targets])
+        return observers[seen], targets[seen]
+
+    def send_gamestates(self, remaining_ticks):
+        if not self.names:
+            return
+        p = self.players
+        rows = np.column_stack([p[field] for field in FIELDS]).tolist()
+        states = []
+        for name, row in zip(self.names, rows):
+            state = dict(zip(FIELDS, row))
+            state["name"] = name
+            state["size"] = PLAYER_SIZE
+            state["respawn"] = int(state["respawn"])
+            state["shootstate"] = int(state["shootstate"])
+            states.append(state)
+        seen = [[] for _ in self.names]
+        for observer, target in zip(*self.visible()):
+            seen[observer].append(states[target])
+
+        # Everything but the own player and the visible players is the same for every client.
+        q = self.projectiles
+        projectiles = [{"x": x, "y": y, "theta": theta, "type": int(kind), "dead": int(dead)}
+                       for x, y, theta, kind, dead in zip(q["x"].tolist(), q["y"].tolist(), q["theta"].tolist(),
+                                                          q["type"].tolist(), q["dead"].tolist())]
+        shared = (',"projectiles":' + json.dumps(projectiles) + ',"walls":' + self.walls_json +
+                  ',"ranking":' + json.dumps(self.ranking) + ',"remaining_ticks":' + str(remaining_ticks) + '}}\n')
+        now = time.time()
+        for client in self.clients.values():
+            if client.index < 0 or client.conn.closed:
+                continue
+            line = ('{"gamestate":{"player":' + json.dumps(states[client.index]) +
+                    ',"players":' + json.dumps(seen[client.index]) + shared)
+            client.conn.write(line.encode("utf-8"), now)
+            client.sent = now
+            client.waiting = True
+
+    def report(self, elapsed):
+        out = [str(self.ticks) + " ticks in " + str(round(elapsed, 2)) + "s, " +
+               str(round(self.ticks / max(elapsed, 1e-9), 1)) + " ticks/s" +
+               (" (target " + str(self.tps) + ")" if self.tps > 0 else " (lockstep)"),
+               "ranking: " + json.dumps(self.ranking, sort_keys=True)]
+        for client in sorted(self.clients.values(), key=lambda c: c.name or ""):
+            if client.index < 0:
+                continue
+            out.append("  %-24s missed %d/%d ticks, latency %s" % (
+                client.name, client.missed, client.ticks, client.latency.summary()))
+        return "\n".join(out)
+
+    def quit(self):
+        self.server.close()
+        for client in list(self.clients.values()):
+            client.conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Headless Into Darkness server for load testing AIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2016)
+    parser.add_argument("--tps", type=float, default=30.0,
+                        help="ticks per second, 0 runs in lockstep as fast as the clients answer")
+    parser.add_argument("--ticks", type=int, default=3000,
+                        help="length of the game in ticks")
+    parser.add_argument("--lobby", type=float, default=5.0,
+                        help="seconds the lobby waits for clients")
+    parser.add_argument("--map", metavar="FILE",
+                        help="json list of walls, a random map otherwise")
+    parser.add_argument("--walls", type=int, default=40,
+                        help="number of walls of the random map")
+    parser.add_argument("--size", type=float, default=60.0,
+                        help="edge length of the random map")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.map:
+        with open(args.map) as f:
+            walls = json.load(f)
+    else:
+        walls = random_walls(args.walls, args.size, random.Random(args.seed))
+    Simulator(walls, args.host, args.port, args.tps, args.ticks, args.lobby, args.seed).run()